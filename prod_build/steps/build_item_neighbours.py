@@ -0,0 +1,71 @@
+import dvc.api
+import numpy as np
+import pandas as pd
+from etl_utils import ParquetChunkWriter
+
+params = dvc.api.params_show()
+
+
+def build_item_neighbours():
+    """
+    Build item-to-item recommendations: top ITEM_NEIGHBOURS_K most similar
+    items (by cosine similarity of ALS item factors) for each item.
+    """
+
+    assert params['ITEM_NEIGHBOURS_K'] > 0
+    assert params['ITEM_NEIGHBOURS_BATCH_SIZE'] > 0
+
+    # Загружаем факторы товаров модели ALS
+    item_factors = pd.read_parquet(
+        'recs/als_item_factors.parquet', columns=['item_id', 'factors']
+    )
+    item_ids = item_factors['item_id'].to_numpy(dtype='int32')
+    factors = np.stack(item_factors['factors'].to_numpy()).astype('float32')
+
+    assert len(item_ids) > 1, 'Not enough items to find neighbours'
+
+    # Нормируем факторы: косинусная близость - скалярное произведение
+    norms = np.linalg.norm(factors, axis=1, keepdims=True)
+    factors /= np.where(norms > 0, norms, 1)
+
+    n_neighbours = min(params['ITEM_NEIGHBOURS_K'], len(item_ids) - 1)
+    batch_size = params['ITEM_NEIGHBOURS_BATCH_SIZE']
+
+    # Считаем близости частями по ITEM_NEIGHBOURS_BATCH_SIZE товаров
+    # (в памяти - матрица близостей только текущей части) и сразу
+    # дописываем соседей части в итоговый файл
+    with ParquetChunkWriter('recs/item_neighbours.parquet') as writer:
+        for start in range(0, len(item_ids), batch_size):
+            stop = min(start + batch_size, len(item_ids))
+            # NB: храним близости со знаком минус (argpartition отбирает
+            # наименьшие), чтобы не создавать копию матрицы
+            distance = factors[start:stop] @ factors.T
+            np.negative(distance, out=distance)
+
+            # Исключаем сам товар из списка его соседей
+            distance[np.arange(stop - start), np.arange(start, stop)] = np.inf
+
+            # Отбираем n_neighbours ближайших без полной сортировки,
+            # затем сортируем только их по убыванию близости
+            top = np.argpartition(
+                distance, n_neighbours - 1, axis=1
+            )[:, :n_neighbours]
+            top_scores = -np.take_along_axis(distance, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+
+            writer.write(pd.DataFrame({
+                'item_id': np.repeat(item_ids[start:stop], n_neighbours),
+                'neighbour_id': item_ids[
+                    np.take_along_axis(top, order, axis=1).ravel()
+                ],
+                'score': np.take_along_axis(top_scores, order, axis=1).ravel()
+            }))
+
+        print(
+            f'Item neighbours: {n_neighbours} for each of '
+            f'{len(item_ids)} items'
+        )
+
+
+if __name__ == '__main__':
+    build_item_neighbours()
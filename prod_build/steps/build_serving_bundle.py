@@ -0,0 +1,80 @@
+import sys
+from pathlib import Path
+
+import dvc.api
+import pandas as pd
+
+# Формат бандла и хранилища рекомендаций берем из кода сервиса,
+# чтобы сервис мог отображать бандл в память без преобразований
+sys.path.append(str(Path(__file__).parents[2] / 'service' / 'app'))
+from bundle import save_bundle  # noqa: E402
+from stores import (ItemCategoryMap, ItemFactorsStore,  # noqa: E402
+                    ItemNeighboursStore, PersonalRecsStore,
+                    TopPopularStore)
+
+params = dvc.api.params_show()
+build_date = dvc.api.params_show('build_date.yaml')
+
+
+def build_serving_bundle():
+    """Build serving bundle: pre-sorted fixed-width arrays for the service."""
+
+    assert params['BUNDLE_TOP_POPULAR_MAX_N']
+    assert params['BUNDLE_FOLD_IN_MAX_CANDIDATES']
+    assert build_date['build_date']
+
+    # Загружаем результаты предыдущих шагов
+    items_train = pd.read_parquet(
+        'recs/items_train.parquet', columns=['item_id', 'category_id']
+    )
+    top_popular = pd.read_parquet(
+        'recs/top_popular.parquet', columns=['item_id', 'score', 'category_id']
+    )
+    personal_als = pd.read_parquet(
+        'recs/weighted_als.parquet', columns=['user_id', 'item_id', 'score']
+    )
+    item_factors = pd.read_parquet(
+        'recs/als_item_factors.parquet', columns=['item_id', 'factors']
+    )
+    item_neighbours = pd.read_parquet(
+        'recs/item_neighbours.parquet',
+        columns=['item_id', 'neighbour_id', 'score']
+    )
+
+    # Упаковываем таблицы в хранилища на массивах фиксированной ширины:
+    # отображение item_id -> category_id, топ-популярные по категориям,
+    # персональные рекомендации (смещения по пользователям, товары, скоры),
+    # факторы товаров ALS для онлайн fold-in (кандидаты - самые популярные
+    # товары), похожие товары
+    stores = {
+        'item_cats': ItemCategoryMap.from_frame(items_train),
+        'top_popular': TopPopularStore.from_frame(
+            top_popular, max_n=params['BUNDLE_TOP_POPULAR_MAX_N']
+        ),
+        'personal': PersonalRecsStore.from_frame(personal_als),
+        'item_factors': ItemFactorsStore.from_frame(
+            item_factors,
+            regularization=item_factors.attrs['regularization'],
+            confidence=item_factors.attrs['confidence'],
+            popular_items=top_popular.sort_values(
+                by='score', ascending=False, kind='stable'
+            )['item_id'].to_numpy(),
+            max_candidates=params['BUNDLE_FOLD_IN_MAX_CANDIDATES']
+        ),
+        'item_neighbours': ItemNeighboursStore.from_frame(item_neighbours)
+    }
+
+    # Сохраняем бандл локально
+    save_bundle(
+        'recs/bundle',
+        stores=stores,
+        meta={
+            'top_popular_max_n': params['BUNDLE_TOP_POPULAR_MAX_N'],
+            'fold_in_max_candidates': params['BUNDLE_FOLD_IN_MAX_CANDIDATES'],
+            'build_date': build_date['build_date']
+        }
+    )
+
+
+if __name__ == '__main__':
+    build_serving_bundle()
@@ -1,15 +1,66 @@
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
 import dvc.api
+import numpy as np
 import pandas as pd
 import scipy
 import threadpoolctl
+from etl_utils import ParquetChunkWriter
 from implicit.als import AlternatingLeastSquares
-from sklearn.preprocessing import LabelEncoder
+
+# Построение матрицы взаимодействий - общее с ноутбуками экспериментов
+sys.path.append(str(Path(__file__).parents[2]))
+from utils.interactions import (InteractionsMatrix,  # noqa: E402
+                                build_interactions_matrix)
+
+# Поиск по отсортированным идентификаторам - общий с кодом сервиса
+sys.path.append(str(Path(__file__).parents[2] / 'service' / 'app'))
+from stores import find_sorted  # noqa: E402
 
 # Следуем рекомендациям от разработчиков implicit
 threadpoolctl.threadpool_limits(1, "blas")
 
 params = dvc.api.params_show()
 
+# Директория с результатами обучения ALS (факторы и соответствие
+# строк факторов идентификаторам) - начальное приближение для warm start
+ALS_STATE_PATH = Path('cache/als')
+
+# Параметры, при изменении которых факторы предыдущей сборки
+# не используются для warm start
+ALS_STATE_PARAMS = [
+    'ALS_VIEW_WEIGHT', 'ALS_ADDTOCART_WEIGHT', 'ALS_FACTORS',
+    'ALS_REGULARIZATION'
+]
+
+# Максимальное кол-во пользователей для сравнения рекомендаций
+# warm start и cold start моделей
+COMPARE_SAMPLE_SIZE = 10000
+
+# Кол-во ненулевых элементов матрицы взаимодействий, скалярные произведения
+# факторов для которых считаются за один раз при расчете функции потерь
+LOSS_CHUNK_NNZ = 1_000_000
+
+# Длительность (сек) этапов расчета
+phase_durations = {}
+
+
+@contextmanager
+def phase(name: str):
+    """Measure duration of a build phase."""
+
+    t_start = time.perf_counter()
+    yield
+    phase_durations[name] = time.perf_counter() - t_start
+    print(f'{name}: {phase_durations[name]:.2f}s')
+
 
 def build_weighted_als():
     """Build weighted ALS personal recommendations."""
@@ -22,102 +73,368 @@ def build_weighted_als():
     assert params['ALS_ITERATIONS']
     assert params['ALS_REGULARIZATION']
     assert isinstance(params['ALS_FILTER_ALREADY_LIKED'], bool)
+    assert isinstance(params['ALS_WARM_START'], bool)
+    assert params['ALS_WARM_START_ITERATIONS']
+    assert isinstance(params['ALS_WARM_START_COMPARE'], bool)
+    assert params['ALS_RECOMMEND_BATCH_SIZE'] > 0
+    assert params['ALS_RECOMMEND_N_JOBS'] >= 0
 
     # Загружаем прредобработанные данные
-    events_train = pd.read_parquet('cache/events_train.parquet')
-
-    # Подготовим таблицу событий для построения матрицы:
-    # оставим только события просмора/добалвнеия в корзину,
-    # удалим для каждого пользователя дублирующиеся события
-    # взаимодействия (с тем же товаром)
-    events_train_als = (
-        events_train
-        .query('event == "addtocart" or event == "view"')
-        .drop_duplicates(['user_id', 'event', 'item_id'])
-        [['user_id', 'item_id', 'event']]
-        .reset_index(drop=True)
-    )
+    with phase('load'):
+        events_train = pd.read_parquet(
+            'cache/events_train.parquet',
+            columns=['user_id', 'item_id', 'event']
+        )
 
-    # Добваляем столбец с весами
-    # NB: в таблице уже оставлено только два типа событий (view и addtocart)
-    events_train_als['weight'] = events_train_als['event'].map(
-        lambda x: params['ALS_VIEW_WEIGHT'] if x == 'view'
-        else params['ALS_ADDTOCART_WEIGHT']
-    ).astype('float32')
-
-    # Создаем энкодеры для перекодирования идентификаторов user_id, item_id
-    # в натруральный ряд  {0, 1, ...} для построения матрицы взаимодействий
-    user_encoder = LabelEncoder().fit(
-        events_train_als['user_id'].drop_duplicates().sort_values()
-    )
-    item_encoder = LabelEncoder().fit(
-        events_train_als['item_id'].drop_duplicates().sort_values()
-    )
+    # Строим матрицу взаимодействий (user x item) по событиям просмотра
+    # и добавления в корзину с разными весами
+    with phase('matrix'):
+        interactions = build_interactions_matrix(
+            events_train,
+            weights={
+                'view': params['ALS_VIEW_WEIGHT'],
+                'addtocart': params['ALS_ADDTOCART_WEIGHT']
+            }
+        )
+        user_item_matrix = interactions.matrix
 
-    # создаём sparse-матрицу (user x item)
-    user_item_matrix = scipy.sparse.csr_matrix(
-        # кортеж вида (data, (row_index, col_index))
-        (
-            # Используем разные веса для разных событий
-            events_train_als['weight'].to_numpy(),
-            (
-                user_encoder.transform(events_train_als['user_id']),
-                item_encoder.transform(events_train_als['item_id'])
-            )
+    # Начальное приближение для warm start: факторы предыдущей сборки
+    init_factors = None
+    if params['ALS_WARM_START']:
+        init_factors = load_init_factors(interactions)
+
+    # Раскладываем матрицу с помощью ALS: с нуля или, в режиме warm start,
+    # дообучая факторы предыдущей сборки за меньшее число итераций
+    with phase('fit'):
+        als_model = fit_als(
+            user_item_matrix,
+            iterations=(
+                params['ALS_ITERATIONS'] if init_factors is None
+                else params['ALS_WARM_START_ITERATIONS']
+            ),
+            init_factors=init_factors
         )
-    )
 
-    # Раскладываем матрицу с помощью ALS
+    if init_factors is not None and params['ALS_WARM_START_COMPARE']:
+        compare_with_cold_start(
+            als_model, phase_durations['fit'], user_item_matrix
+        )
+
+    # Сохраняем факторы с соответствием строк идентификаторам,
+    # факторы товаров - также для онлайн fold-in в сервисе
+    with phase('save_factors'):
+        save_als_state(interactions, als_model)
+        save_item_factors(
+            interactions.item_ids, als_model, 'recs/als_item_factors.parquet'
+        )
+
+    print('Building recs, please wait, this might take a while...')
+    # Получаем рекомендации для всех пользователй из обучающей выборки
+    # частями по ALS_RECOMMEND_BATCH_SIZE пользователей, части считаются
+    # параллельно и сразу дописываются в итоговый файл
+    with phase('recommend'):
+        write_recommendations(
+            als_model,
+            user_item_matrix,
+            user_ids=interactions.user_ids,
+            item_ids=interactions.item_ids,
+            path='recs/weighted_als.parquet',
+            batch_size=params['ALS_RECOMMEND_BATCH_SIZE'],
+            n_jobs=params['ALS_RECOMMEND_N_JOBS'] or os.cpu_count()
+        )
+
+    print('Phase durations (s): ' + ', '.join(
+        f'{name} {duration:.2f}' for name, duration in phase_durations.items()
+    ))
+
+
+def fit_als(
+    user_item_matrix: scipy.sparse.csr_matrix,
+    iterations: int,
+    init_factors: tuple[np.ndarray, np.ndarray] | None = None
+) -> AlternatingLeastSquares:
+    """Fit ALS model, starting from given (user, item) factors if any."""
+
     als_model = AlternatingLeastSquares(
         factors=params['ALS_FACTORS'],
-        iterations=params['ALS_ITERATIONS'],
+        iterations=iterations,
         regularization=params['ALS_REGULARIZATION'],
         random_state=params['RANDOM_STATE']
     )
+
+    # implicit инициализирует случайными значениями только незаданные факторы
+    if init_factors is not None:
+        als_model.user_factors, als_model.item_factors = (
+            factors.copy() for factors in init_factors
+        )
+
     als_model.fit(user_item_matrix)
 
-    print('Building recs, please wait, this might take a while...')
-    # Получаем рекомендации для всех пользователй из обучающей выборки
-    als_item_ids, als_scores = als_model.recommend(
-        range(len(user_encoder.classes_)),
-        user_item_matrix,
-        filter_already_liked_items=params['ALS_FILTER_ALREADY_LIKED'],
-        N=params['N_RECS_USER']
-    )
+    return als_model
+
+
+def load_init_factors(
+    interactions: InteractionsMatrix
+) -> tuple[np.ndarray, np.ndarray] | None:
+    """
+    Get initial (user, item) factors for warm start from the previous build.
+
+    Rows of previous factors are matched to the current matrix rows/columns
+    by ids, users/items that are new get small random rows (as implicit
+    initializes them), rows of users/items that are gone are dropped.
+    Returns None (cold start) if there are no previous factors or they were
+    fitted with other parameters.
+    """
+
+    try:
+        with open(ALS_STATE_PATH / 'state.json', 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        print('No previous ALS factors, cold start')
+        return None
+
+    if state['params'] != {name: params[name] for name in ALS_STATE_PARAMS}:
+        print('ALS parameters changed, cold start')
+        return None
+
+    random_state = np.random.default_rng(params['RANDOM_STATE'])
+    init_factors = []
+    for name, ids in [
+        ('user', interactions.user_ids), ('item', interactions.item_ids)
+    ]:
+        prev_ids = np.load(ALS_STATE_PATH / f'{name}_ids.npy')
+        prev_factors = np.load(ALS_STATE_PATH / f'{name}_factors.npy')
 
-    # Перепаковываем рекомендации в таблицу формата
-    # (user_id, item_id, score)
-    personal_als = pd.DataFrame({
-        'user_id': range(len(user_encoder.classes_)),
-        'item_id': als_item_ids.tolist(),
-        'score': als_scores.tolist()
+        # Идентификаторы отсортированы: ищем строки предыдущих факторов
+        # бинарным поиском
+        rows = find_sorted(prev_ids, ids)
+        found = rows >= 0
+
+        factors = random_state.random(
+            (len(ids), prev_factors.shape[1]), dtype=prev_factors.dtype
+        ) * 0.01
+        factors[found] = prev_factors[rows[found]]
+        init_factors.append(factors)
+
+        print(
+            f'Warm start {name} factors: {found.sum()} previous, '
+            f'{(~found).sum()} new'
+        )
+
+    return tuple(init_factors)
+
+
+def save_als_state(
+    interactions: InteractionsMatrix,
+    als_model: AlternatingLeastSquares
+):
+    """Save fitted factors along with id mappings and model parameters."""
+
+    interactions.save_ids(ALS_STATE_PATH)
+    np.save(ALS_STATE_PATH / 'user_factors.npy', als_model.user_factors)
+    np.save(ALS_STATE_PATH / 'item_factors.npy', als_model.item_factors)
+
+    with open(ALS_STATE_PATH / 'state.json', 'w') as f:
+        json.dump(
+            {'params': {name: params[name] for name in ALS_STATE_PARAMS}},
+            f, indent=2
+        )
+
+
+def save_item_factors(
+    item_ids: np.ndarray,
+    als_model: AlternatingLeastSquares,
+    path: str
+):
+    """
+    Save item factors as a table (item_id, factors) for online fold-in of
+    users without personal recommendations. Model parameters needed for
+    fold-in (regularization and confidence of a view event) are saved in
+    table attrs.
+    """
+
+    item_factors = pd.DataFrame({
+        'item_id': item_ids,
+        'factors': list(als_model.item_factors)
     })
-    personal_als = personal_als.explode(
-        ['item_id', 'score'], ignore_index=True
+    item_factors.attrs = {
+        'regularization': params['ALS_REGULARIZATION'],
+        'confidence': params['ALS_VIEW_WEIGHT']
+    }
+    item_factors.to_parquet(path)
+
+
+def calculate_loss(
+    user_item_matrix: scipy.sparse.csr_matrix,
+    user_factors: np.ndarray,
+    item_factors: np.ndarray,
+    regularization: float
+) -> float:
+    """
+    Get training loss of an implicit ALS model (the same value as the loss
+    reported by implicit), user_item_matrix - confidence matrix:
+
+        (Σ loss(u, i) + regularization·(Σ|x|² + Σ|y|²)) / Σ c
+
+    where sums are over all (user, item) pairs, s = x·y. For zero entries
+    of the matrix c = 1 and loss = s², for non-zero ones c = |value| and
+    loss = c·(1 - 2p·s + s²), p = 1 for positive values (0 for negative),
+    i.e. c·(1 - s)² for positive values.
+    """
+
+    user_factors = np.asarray(user_factors, dtype='float64')
+    item_factors = np.asarray(item_factors, dtype='float64')
+    n_users, n_items = user_item_matrix.shape
+
+    # Все пары с c = 1, p = 0: Σ xᵀ·YᵀY·x
+    loss = np.sum(
+        (user_factors @ (item_factors.T @ item_factors)) * user_factors
+    )
+
+    # Поправка для ненулевых элементов: c·(1 - 2p·s + s²) вместо s²
+    rows = np.repeat(
+        np.arange(n_users), np.diff(user_item_matrix.indptr)
     )
+    total_confidence = 0.
+    for start in range(0, user_item_matrix.nnz, LOSS_CHUNK_NNZ):
+        chunk = slice(start, start + LOSS_CHUNK_NNZ)
+        confidence = user_item_matrix.data[chunk].astype('float64')
+        preference = (confidence > 0).astype('float64')
+        confidence = np.abs(confidence)
+        scores = np.einsum(
+            'nf,nf->n',
+            user_factors[rows[chunk]],
+            item_factors[user_item_matrix.indices[chunk]]
+        )
+        loss += np.sum(
+            confidence * (1 - 2 * preference * scores + scores ** 2)
+            - scores ** 2
+        )
+        total_confidence += confidence.sum()
+
+    loss += regularization * (
+        np.sum(user_factors ** 2) + np.sum(item_factors ** 2)
+    )
+
+    return float(loss / (
+        total_confidence + n_users * n_items - user_item_matrix.nnz
+    ))
 
-    # Приводим типы
-    personal_als['user_id'] = personal_als['user_id'].astype('int32')
-    personal_als['item_id'] = personal_als['item_id'].astype('int32')
-    personal_als['score'] = personal_als['score'].astype('float32')
 
-    # Перекодируем индентификаторы в исходные
-    personal_als['user_id'] = (
-        user_encoder.inverse_transform(personal_als['user_id'])
+def compare_with_cold_start(
+    warm_model: AlternatingLeastSquares,
+    warm_fit_duration: float,
+    user_item_matrix: scipy.sparse.csr_matrix
+):
+    """
+    Fit a cold start model with ALS_ITERATIONS iterations and print fit
+    time, training loss and overlap of top N_RECS_USER recommendations
+    (for a sample of users) of warm and cold start models.
+    """
+
+    print('Fitting cold start model for comparison...')
+    t_start = time.perf_counter()
+    cold_model = fit_als(user_item_matrix, iterations=params['ALS_ITERATIONS'])
+    cold_fit_duration = time.perf_counter() - t_start
+
+    user_item_matrix = user_item_matrix.astype('float32')
+    warm_loss, cold_loss = (
+        calculate_loss(
+            user_item_matrix, model.user_factors, model.item_factors,
+            params['ALS_REGULARIZATION']
+        )
+        for model in (warm_model, cold_model)
+    )
+
+    n_users = user_item_matrix.shape[0]
+    users = np.sort(
+        np.random.default_rng(params['RANDOM_STATE']).choice(
+            n_users, min(n_users, COMPARE_SAMPLE_SIZE), replace=False
+        )
     )
-    personal_als['item_id'] = (
-        item_encoder.inverse_transform(personal_als['item_id'])
+    warm_item_ids, cold_item_ids = (
+        model.recommend(
+            users,
+            user_item_matrix[users],
+            filter_already_liked_items=params['ALS_FILTER_ALREADY_LIKED'],
+            N=params['N_RECS_USER']
+        )[0]
+        for model in (warm_model, cold_model)
     )
+    overlap = np.mean([
+        len(np.intersect1d(warm, cold)) / len(cold)
+        for warm, cold in zip(warm_item_ids, cold_item_ids)
+    ])
 
-    # Сортируем таблицу
-    personal_als = personal_als.sort_values(
-        by=['user_id', 'score'],
-        ascending=[True, False],
-        ignore_index=True
+    print(
+        'Warm start vs cold start: '
+        f'fit {warm_fit_duration:.2f}s vs {cold_fit_duration:.2f}s, '
+        f'loss {warm_loss:.6g} vs {cold_loss:.6g}, '
+        f'top-{params["N_RECS_USER"]} recs overlap {overlap:.1%}'
     )
 
-    # Сохраняем таблицу локально
-    personal_als.to_parquet('recs/weighted_als.parquet')
+
+def write_recommendations(
+    als_model: AlternatingLeastSquares,
+    user_item_matrix: scipy.sparse.csr_matrix,
+    user_ids: np.ndarray,
+    item_ids: np.ndarray,
+    path: str,
+    batch_size: int,
+    n_jobs: int
+):
+    """
+    Write recommendations for all users of the user-item matrix to a
+    .parquet file as a (user_id, item_id, score) table sorted by user_id.
+
+    Users are scored in batches of batch_size users by a pool of n_jobs
+    threads (implicit and numpy release the GIL while scoring). Batches are
+    written in user order as soon as they are ready, at most n_jobs batches
+    are kept in memory at once.
+    """
+
+    if n_jobs > 1:
+        # Параллелим по частям пользователей: отключаем собственную
+        # многопоточность implicit, чтобы не создавать лишних потоков
+        als_model.num_threads = 1
+
+    def recommend_batch(start: int) -> pd.DataFrame:
+        stop = min(start + batch_size, len(user_ids))
+        als_item_ids, als_scores = als_model.recommend(
+            np.arange(start, stop),
+            user_item_matrix[start:stop],
+            filter_already_liked_items=params['ALS_FILTER_ALREADY_LIKED'],
+            N=params['N_RECS_USER']
+        )
+
+        # Перепаковываем рекомендации в таблицу формата
+        # (user_id, item_id, score): для каждого пользователя implicit
+        # возвращает строку из N_RECS_USER товаров, отсортированных по
+        # убыванию score, пользователи упорядочены по возрастанию user_id
+        # (порядок классов энкодера), поэтому таблица уже отсортирована.
+        # Исходные идентификаторы получаем индексированием массивов классов
+        # энкодеров
+        return pd.DataFrame({
+            'user_id': np.repeat(user_ids[start:stop], als_item_ids.shape[1]),
+            'item_id': item_ids[als_item_ids.ravel()],
+            'score': als_scores.ravel().astype('float32')
+        })
+
+    with (
+        ThreadPoolExecutor(n_jobs) as executor,
+        ParquetChunkWriter(path) as writer
+    ):
+        # Очередь посчитанных/считающихся частей в порядке пользователей
+        pending = deque()
+        for start in range(0, len(user_ids), batch_size):
+            if len(pending) >= n_jobs:
+                writer.write(pending.popleft().result())
+            pending.append(executor.submit(recommend_batch, start))
+
+        while pending:
+            writer.write(pending.popleft().result())
+
+        print(f'{path}: {writer.n_rows} recommendations')
 
 
 if __name__ == '__main__':
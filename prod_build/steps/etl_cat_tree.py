@@ -4,6 +4,76 @@ import pandas as pd
 params = dvc.api.params_show()
 
 
+def resolve_cat_tree(
+    category_ids: list[int],
+    parent_ids: list[int | None]
+) -> tuple[list[tuple[int, ...]], list[int]]:
+    """
+    Resolve category tree given by parent links in a single pass.
+
+    Returns for each category a tuple of its parents (from the top level
+    category to the immediate parent, empty for top level categories)
+    and id of its top level category (the category itself for top level
+    categories). Each category is resolved once: its parents are the
+    parents of its parent plus the parent itself.
+
+    Raises ValueError if there are categories with unknown parents
+    (orphans) or cycles of parent links.
+    """
+
+    parent_of = {
+        category_id: (None if pd.isna(parent_id) else int(parent_id))
+        for category_id, parent_id in zip(category_ids, parent_ids)
+    }
+
+    # Категории с неизвестными parent_id
+    orphans = sorted(
+        category_id for category_id, parent_id in parent_of.items()
+        if parent_id is not None and parent_id not in parent_of
+    )
+    if orphans:
+        raise ValueError(
+            f'{len(orphans)} categories with unknown parent_id: {orphans}'
+        )
+
+    resolved = {}
+
+    for category_id in category_ids:
+
+        # Поднимаемся по родителям до категории верхнего уровня
+        # или до уже обработанной категории, запоминая путь
+        path = []
+        on_path = set()
+        while category_id not in resolved:
+            if category_id in on_path:
+                raise ValueError(
+                    f'Cycle of parent links: {path[path.index(category_id):]}'
+                )
+            path.append(category_id)
+            on_path.add(category_id)
+
+            if parent_of[category_id] is None:
+                resolved[category_id] = ()
+                path.pop()
+                break
+
+            category_id = parent_of[category_id]
+
+        # Спускаемся обратно по пути: родители категории - это
+        # родители родителя плюс сам родитель
+        for category_id in reversed(path):
+            parent_id = parent_of[category_id]
+            resolved[category_id] = resolved[parent_id] + (parent_id,)
+
+    parents = [resolved[category_id] for category_id in category_ids]
+    top_cat_ids = [
+        category_parents[0] if category_parents else category_id
+        for category_id, category_parents in zip(category_ids, parents)
+    ]
+
+    return parents, top_cat_ids
+
+
 def etl_cat_tree():
     """Category tree data ETL step."""
 
@@ -21,65 +91,11 @@ def etl_cat_tree():
     # Проверка на отсутствие дубликатов category_id
     assert cat_tree['category_id'].duplicated().sum() == 0
 
-    # Добалвяем столбец 'parents' с перечнем родителей
-    cat_tree['parents'] = pd.NA
-
-    # Получим содержимое таблицы в виде списка кортежей
-    # (category_id, parent_id)
-    categories = list(cat_tree[['category_id', 'parent_id']]
-                      .itertuples(index=False))
-
-    # Временно поменяем индекс таблицы на 'category_id'
-    cat_tree.set_index('category_id', inplace=True)
-
-    # Итерируем, пока в списке кортежей есть элементы (необработанне категории)
-    while (categories_left := len(categories)):
-
-        # Проходим по копии (!) списка необработанных категорий
-        for category_id, parent_id in list(categories):
-
-            # Если категория не является категорией верхнего уровня
-            # И ее родительская категория еще не обработана
-            # (не размечена в таблице) переходим к следующей
-            if (
-                pd.notna(parent_id)
-                and parent_id not in (
-                    cat_tree[cat_tree['parents'].notna()].index
-                )
-            ):
-                continue
-
-            # Для всех категорий, кроме верхнего уровня, список родителей это:
-            # родители родителя плюс сам родитель :)
-            # А для верхнего уровня список родителей пустой.
-            cat_tree.at[category_id, 'parents'] = (
-                cat_tree.at[parent_id, 'parents'] + [int(parent_id)]
-                if pd.notna(parent_id) else []
-            )
-
-            # Удаляем категорию из списка необработанных
-            categories.pop(categories.index((category_id, parent_id)))
-
-        # Если после прохода число категорий в списке не уменьшилось
-        # то прерываем цикл (битые данные: категории с неизвестными parent_id)
-        if len(categories) == categories_left:
-            break
-
-    # Возвращаем 'category_id' обратно в столбцы
-    cat_tree.reset_index(inplace=True)
-
-    # Перепакуем списки в кортежи
-    cat_tree['parents'] = cat_tree['parents'].map(
-        lambda x: tuple(x) if isinstance(x, list) else x
-    )
-
-    # Проверяем, что обработали все категории
-    assert len(categories) == 0
-
-    # Добавляем признак категории верхнего уровня
-    cat_tree['top_cat_id'] = (
-        cat_tree[['category_id', 'parents']]
-        .apply(lambda x: x.parents[0] if x.parents else x.category_id, axis=1)
+    # Для каждой категории определяем список родителей (от верхнего
+    # уровня к непосредственному родителю) и категорию верхнего уровня
+    cat_tree['parents'], cat_tree['top_cat_id'] = resolve_cat_tree(
+        cat_tree['category_id'].tolist(),
+        cat_tree['parent_id'].astype('Int64').tolist()
     )
 
     # Сохраняем обработанную таблицу локально
@@ -1,37 +1,59 @@
 import dvc.api
 import pandas as pd
+from etl_utils import IncrementalDataset
 
 params = dvc.api.params_show()
 
+# Типы столбцов исходной таблицы событий
+CSV_EVENTS_DTYPES = {
+    'timestamp': 'int64',
+    'visitorid': 'int32',
+    'event': pd.CategoricalDtype(['view', 'addtocart', 'transaction']),
+    'itemid': 'int32',
+    'transactionid': 'Int32'
+}
+
 
 def etl_events():
     """Events ETL step."""
 
     assert params['PATH_CSV_EVENTS']
-
-    # Загрузим таблицу с каегориями товаров с предыдущего шага
-    items = pd.read_parquet('cache/items.parquet')
-
-    events = (
-        pd.read_csv(params['PATH_CSV_EVENTS'])
-        .rename(columns={
-            'visitorid': 'user_id',
-            'itemid': 'item_id',
-            'transactionid': 'transaction_id'
-        })
-        .sort_values(by='timestamp', ignore_index=True)
-    )
+    assert params['ETL_CSV_CHUNK_SIZE']
+    assert isinstance(params['ETL_INCREMENTAL'], bool)
+
+    # Таблицу событий читаем по частям (в памяти - только текущая часть)
+    # и сразу дописываем обработанную часть в датасет, разбитый по датам.
+    # В инкрементальном режиме обрабатываются только строки, дописанные
+    # в исходную таблицу с момента предыдущего запуска.
+    # NB: события товаров, отсутствующих в каталоге, удаляются при разбиении
+    # на обучающую и тестовую выборки: каталог также пополняется
+    # инкрементально, и товар может появиться в нем позднее событий
+    with IncrementalDataset(
+        'cache/events',
+        sources=[params['PATH_CSV_EVENTS']],
+        incremental=params['ETL_INCREMENTAL']
+    ) as events:
+        for chunk in events.read_new_rows(
+            params['PATH_CSV_EVENTS'],
+            dtype=CSV_EVENTS_DTYPES,
+            chunksize=params['ETL_CSV_CHUNK_SIZE']
+        ):
+            events.write(transform_events_chunk(chunk))
+
+
+def transform_events_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Transform a chunk of events table."""
+
+    events = chunk.rename(columns={
+        'visitorid': 'user_id',
+        'itemid': 'item_id',
+        'transactionid': 'transaction_id'
+    })
 
     # Приведем timestamp к типу datetime
     events['timestamp'] = pd.to_datetime(events['timestamp'], unit='ms')
 
-    # Удалим из таблицы событий товары, отсутствующие в каталоге items
-    events = events[
-        events['item_id'].isin(items['item_id'].drop_duplicates())
-    ].reset_index(drop=True)
-
-    # Сохраняем обработанную таблицу локально
-    events.to_parquet('cache/events.parquet')
+    return events
 
 
 if __name__ == '__main__':
@@ -1,54 +1,74 @@
 import dvc.api
 import pandas as pd
+from etl_utils import IncrementalDataset, file_hash
 
 params = dvc.api.params_show()
 
+# Типы столбцов исходных таблиц свойств товаров
+# NB: 'value' содержит значения разных свойств, поэтому читается как строка
+# и приводится к int только для свойства 'categoryid'
+CSV_ITEMS_DTYPES = {
+    'timestamp': 'int64',
+    'itemid': 'int32',
+    'property': 'str',
+    'value': 'str'
+}
+
 
 def etl_items():
     """Item properties data ETL step."""
 
     assert params['PATH_CSV_ITEMS1']
     assert params['PATH_CSV_ITEMS2']
+    assert params['ETL_CSV_CHUNK_SIZE']
+    assert isinstance(params['ETL_INCREMENTAL'], bool)
 
-    # Загружаем данные из таблиц, переименовываем столбцы
-    items = pd.concat([
-        pd.read_csv(params['PATH_CSV_ITEMS1']),
-        pd.read_csv(params['PATH_CSV_ITEMS2'])
-    ]).rename(columns={'itemid': 'item_id'})
-
-    # Из всех значений 'property' оставляем только 'categoryid',
-    # приводим 'value' к типу int
-    items = (
-        items[items['property'] == 'categoryid']
-        .astype(dtype={'value': 'int'})
+    # Загрузим подготовленную таблицу с деревом категорий
+    cat_tree = pd.read_parquet(
+        'cache/cat_tree.parquet',
+        columns=['category_id', 'parents', 'top_cat_id']
     )
 
-    # Приводим 'timestamp' к типу datetime
-    items['timestamp'] = pd.to_datetime(
-        items['timestamp'], unit='ms'
-    )
+    # Таблицы свойств товаров читаем по частям (в памяти - только текущая
+    # часть) и сразу дописываем обработанную часть в датасет, разбитый
+    # по датам. В инкрементальном режиме обрабатываются только строки,
+    # дописанные в исходные таблицы с момента предыдущего запуска.
+    # NB: при изменении дерева категорий датасет пересобирается полностью
+    with IncrementalDataset(
+        'cache/items',
+        sources=[params['PATH_CSV_ITEMS1'], params['PATH_CSV_ITEMS2']],
+        fingerprint={'cat_tree': file_hash('cache/cat_tree.parquet')},
+        incremental=params['ETL_INCREMENTAL']
+    ) as items:
+        for source in items.sources:
+            for chunk in items.read_new_rows(
+                source,
+                dtype=CSV_ITEMS_DTYPES,
+                chunksize=params['ETL_CSV_CHUNK_SIZE']
+            ):
+                items.write(transform_items_chunk(chunk, cat_tree))
+
 
-    # Удалим столбец 'property', столбец 'value' переименуем в 'category_id'
+def transform_items_chunk(
+    chunk: pd.DataFrame,
+    cat_tree: pd.DataFrame
+) -> pd.DataFrame:
+    """Transform a chunk of item properties table."""
+
+    # Из всех значений 'property' оставляем только 'categoryid',
+    # приводим 'value' к типу int
     items = (
-        items
+        chunk[chunk['property'] == 'categoryid']
         .drop(columns='property')
-        .rename(columns={'value': 'category_id'})
-        # Отсортируем таблицу
-        .sort_values(by=['item_id', 'timestamp'], ignore_index=True)
+        .rename(columns={'itemid': 'item_id', 'value': 'category_id'})
+        .astype(dtype={'category_id': 'int32'})
     )
 
-    # Загрузим подготовленную таблицу с деревом категорий
-    cat_tree = pd.read_parquet('cache/cat_tree.parquet')
+    # Приводим 'timestamp' к типу datetime
+    items['timestamp'] = pd.to_datetime(items['timestamp'], unit='ms')
 
     # Добавим в таблицу items признаки 'parents', 'top_cat_id'
-    items = items.merge(
-        cat_tree[['category_id', 'parents', 'top_cat_id']],
-        on='category_id',
-        how='inner'
-    ).reset_index(drop=True)
-
-    # Сохраняем обработанные таблицы локально
-    items.to_parquet('cache/items.parquet')
+    return items.merge(cat_tree, on='category_id', how='inner')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Версия формата партиционированных датасетов (при изменении датасеты
+# пересобираются полностью)
+DATASET_FORMAT_VERSION = 1
+
+# Файл состояния датасета
+# NB: файлы, начинающиеся с '_', игнорируются при чтении датасета
+STATE_FILE = '_ingest_state.json'
+
+# Размер начального фрагмента исходного файла, по хэшу которого
+# проверяется, что файл только дописывался, а не был перезаписан
+HEAD_HASH_SIZE = 1 << 20
+
+
+class ParquetChunkWriter:
+    """
+    Write a table to a .parquet file chunk by chunk, so that only the
+    current chunk is kept in memory. Schema of the file is defined by
+    the first non-empty chunk, following chunks are cast to it.
+
+    Usage:
+        with ParquetChunkWriter(path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.n_rows = 0
+        self._writer = None
+        self._empty_chunk = None
+
+    def write(self, chunk: pd.DataFrame):
+        """Append chunk to the file."""
+
+        if chunk.empty:
+            self._empty_chunk = chunk
+            return
+
+        table = pa.Table.from_pandas(
+            chunk,
+            schema=self._writer.schema if self._writer else None,
+            preserve_index=False
+        )
+
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+
+        self._writer.write_table(table)
+        self.n_rows += len(chunk)
+
+    def close(self):
+        """Close the file, write an empty table if no rows were written."""
+
+        if self._writer is not None:
+            self._writer.close()
+        elif self._empty_chunk is not None:
+            self._empty_chunk.to_parquet(self.path, index=False)
+
+    def __enter__(self) -> 'ParquetChunkWriter':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def file_hash(path: str, size: int | None = None) -> str:
+    """Get md5 hash of the file (or of its first `size` bytes)."""
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        md5.update(f.read(size) if size is not None else f.read())
+
+    return md5.hexdigest()
+
+
+def write_json(path: str, obj: dict):
+    """
+    Write object to a json file atomically: a temporary file is written
+    and then renamed, so a failed write never leaves a broken file.
+    """
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def list_partition_files(path: str) -> dict[str, str]:
+    """
+    Get files of a date-partitioned dataset: {file path relative to
+    the dataset directory: partition date}.
+    """
+
+    return {
+        str(file.relative_to(path)): file.parent.name.split('=', 1)[1]
+        for file in sorted(Path(path).glob('date=*/*.parquet'))
+    }
+
+
+def read_by_partition(
+    path: str,
+    files: list[str],
+    columns: list[str],
+    row_filter: ds.Expression | None = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Read given files of a date-partitioned dataset partition by partition
+    in date order, so that only one partition is kept in memory.
+
+    The filter is pushed down to the parquet reader: row groups which
+    don't match the filter according to their statistics are skipped.
+    """
+
+    files = set(files)
+    partitions = {}
+    for file, date in list_partition_files(path).items():
+        if file in files:
+            partitions.setdefault(date, []).append(str(Path(path) / file))
+
+    for date in sorted(partitions):
+        yield (
+            ds.dataset(partitions[date], format='parquet')
+            .to_table(columns=columns, filter=row_filter)
+            .to_pandas()
+        )
+
+
+class IncrementalDataset:
+    """
+    Date-partitioned .parquet dataset (hive-style `date=YYYY-MM-DD`
+    directories, partitioned by the 'timestamp' column) built from
+    append-only .csv files.
+
+    Each run reads only rows appended to the source files since the
+    previous run (byte offsets of processed data are kept in the dataset
+    state file) and writes them to a new file in every affected partition.
+    The dataset is rebuilt from scratch if incremental mode is off, the
+    state is missing, source files were rewritten (not only appended) or
+    the fingerprint (anything else the dataset depends on) has changed.
+
+    Files written by an unfinished (failed) run are removed by the next run.
+
+    Source files must end with a line break to be updated incrementally
+    (otherwise appended rows would continue the last line). In full
+    rebuild mode such files are read as is, but their offsets are not
+    kept, so the next incremental run rebuilds the dataset.
+
+    Usage:
+        with IncrementalDataset(path, sources, fingerprint) as dataset:
+            for source in dataset.sources:
+                for chunk in dataset.read_new_rows(source, chunksize=...):
+                    dataset.write(transform(chunk))
+
+    Attributes:
+        - **path** - path to the dataset directory
+
+        - **sources** - paths to source .csv files
+
+        - **fingerprint** - json-serializable description of other data
+        and parameters the dataset depends on
+
+        - **incremental** - if False the dataset is always rebuilt
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sources: list[str],
+        fingerprint: dict | None = None,
+        incremental: bool = True
+    ):
+        self.path = Path(path)
+        self.sources = sources
+        self.fingerprint = {
+            **(fingerprint or {}),
+            'format_version': DATASET_FORMAT_VERSION
+        }
+        self.incremental = incremental
+        self.n_rows = 0
+
+        self._state = None
+        self._run_id = None
+        self._new_offsets = {}
+        self._writers = {}
+
+    def _load_state(self) -> dict | None:
+        """Load dataset state if the dataset can be updated incrementally."""
+
+        if not self.incremental:
+            return None
+
+        # NB: битый файл состояния (например, после сбоя при записи
+        # прежним способом) означает полную пересборку
+        try:
+            with open(self.path / STATE_FILE, 'r') as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if state['fingerprint'] != self.fingerprint:
+            return None
+
+        # Исходные файлы должны быть только дописаны с момента
+        # предыдущего запуска
+        for source in self.sources:
+            source_state = state['sources'].get(source)
+            if source_state is None:
+                return None
+            if (
+                Path(source).stat().st_size < source_state['offset']
+                or file_hash(source, HEAD_HASH_SIZE)
+                != source_state['head_hash']
+            ):
+                return None
+
+        return state
+
+    def __enter__(self) -> 'IncrementalDataset':
+        self._state = self._load_state()
+
+        if self._state is None:
+            print(f'Building dataset {self.path} from scratch')
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._state = {
+                'fingerprint': self.fingerprint,
+                'sources': {},
+                'runs': []
+            }
+        else:
+            print(f'Updating dataset {self.path} incrementally')
+
+        # Удаляем файлы незавершенных запусков
+        for file in list_partition_files(self.path):
+            if Path(file).stem not in self._state['runs']:
+                (self.path / file).unlink()
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._run_id = f'part-{time.time_ns()}'
+
+        return self
+
+    def read_new_rows(
+        self,
+        source: str,
+        **read_csv_kwargs
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Read rows appended to the source .csv file since the previous run
+        (all rows if the dataset is built from scratch) in chunks.
+        """
+
+        # NB: предполагается, что во время работы шага исходный файл
+        # не дописывается (выгрузка новых данных уже завершена)
+        offset = self._state['sources'].get(source, {}).get('offset', 0)
+        size = Path(source).stat().st_size
+
+        with open(source, 'rb') as f:
+            # Смещение можно сохранить для следующего инкрементального
+            # запуска, только если последняя строка завершена
+            complete = True
+            if size > 0:
+                f.seek(size - 1)
+                complete = f.read(1) == b'\n'
+            assert complete or not self.incremental, (
+                f'Incomplete last line in {source}'
+            )
+
+            if offset > 0:
+                # Читаем только дописанную часть: без заголовка
+                # (имена столбцов берем из первой строки файла)
+                f.seek(0)
+                read_csv_kwargs['names'] = (
+                    f.readline().decode().strip().split(',')
+                )
+                read_csv_kwargs['header'] = None
+
+            f.seek(offset)
+
+            print(f'Reading {size - offset} new bytes from {source}')
+
+            if size > offset:
+                yield from pd.read_csv(f, **read_csv_kwargs)
+
+        if complete:
+            self._new_offsets[source] = {
+                'offset': size,
+                'head_hash': file_hash(source, HEAD_HASH_SIZE)
+            }
+
+    def write(self, chunk: pd.DataFrame):
+        """
+        Write rows to partitions by date of 'timestamp'. Rows of each
+        partition are sorted by 'timestamp', so that row group statistics
+        allow to skip row groups when reading with a timestamp filter.
+        """
+
+        for date, partition in chunk.groupby(
+            chunk['timestamp'].dt.floor('D'), sort=False
+        ):
+            partition = partition.sort_values('timestamp', kind='stable')
+            date = date.strftime('%Y-%m-%d')
+            if date not in self._writers:
+                (self.path / f'date={date}').mkdir(exist_ok=True)
+                self._writers[date] = ParquetChunkWriter(
+                    str(self.path / f'date={date}' / f'{self._run_id}.parquet')
+                )
+            self._writers[date].write(partition)
+
+        self.n_rows += len(chunk)
+
+    def __exit__(self, exc_type, *exc_info):
+        for writer in self._writers.values():
+            writer.close()
+
+        if exc_type is not None:
+            return
+
+        # Фиксируем запуск: новые файлы и смещения обработанных данных
+        self._state['sources'].update(self._new_offsets)
+        if self._writers:
+            self._state['runs'].append(self._run_id)
+
+        write_json(str(self.path / STATE_FILE), self._state)
+
+        print(
+            f'Dataset {self.path}: {self.n_rows} new rows written to '
+            f'{len(self._writers)} partitions'
+        )
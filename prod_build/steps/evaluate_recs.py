@@ -0,0 +1,229 @@
+import json
+import sys
+from pathlib import Path
+
+import dvc.api
+import numpy as np
+import pandas as pd
+
+# Рекомендации считаем хендлером сервиса по данным бандла, поэтому
+# оффлайн метрики всегда соответствуют текущей логике сервиса
+sys.path.append(str(Path(__file__).parents[2] / 'service' / 'app'))
+from core import RecSysHandler  # noqa: E402
+
+params = dvc.api.params_show()
+
+# Кол-во последних товаров пользователя, передаваемых в запросе
+# (хендлер использует три последних)
+N_LAST_ITEMS = 3
+
+# Пустые позиции в матрицах рекомендаций
+MISSING = -1
+
+# Источники персональной части рекомендаций (см. RecSysHandler.get_recs)
+SOURCES = ('personal', 'fold_in', 'online')
+
+
+def get_handler() -> RecSysHandler:
+    """
+    Get handler memory-mapping the serving bundle (settings - the same the
+    bundle is built with) with fold-in and similar items enabled as in the
+    service (EVAL_FOLD_IN and EVAL_SIMILAR_ITEMS).
+    """
+
+    handler = RecSysHandler(
+        path_recs_top_popular='recs/top_popular.parquet',
+        path_recs_personal='recs/weighted_als.parquet',
+        path_items_train='recs/items_train.parquet',
+        top_popular_max_n=params['BUNDLE_TOP_POPULAR_MAX_N'],
+        path_recs_bundle='recs/bundle',
+        # NB: в режиме бандла пути только включают fold-in и похожие товары
+        path_item_factors=(
+            'recs/als_item_factors.parquet' if params['EVAL_FOLD_IN']
+            else None
+        ),
+        path_item_neighbours=(
+            'recs/item_neighbours.parquet' if params['EVAL_SIMILAR_ITEMS']
+            else None
+        ),
+        fold_in_max_candidates=params['BUNDLE_FOLD_IN_MAX_CANDIDATES']
+    )
+    handler.load_data()
+
+    return handler
+
+
+def get_recs(
+    handler: RecSysHandler,
+    user_ids: np.ndarray,
+    last_items: list[list[int]],
+    n_recs: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get recommendations for a batch of users with `get_recs_batch` of the
+    handler: recs as a matrix of shape (n_users, n_recs) padded with
+    MISSING and the source of personal part of recs for each user
+    (index in SOURCES).
+    """
+
+    batch_recs, sources = handler.get_recs_batch(
+        user_ids=user_ids.tolist(),
+        n_recs=[n_recs] * len(user_ids),
+        last_items=last_items,
+        with_sources=True
+    )
+
+    lengths = np.fromiter(map(len, batch_recs), dtype='int64',
+                          count=len(batch_recs))
+    recs = np.full((len(batch_recs), n_recs), MISSING, dtype='int64')
+    recs[np.arange(n_recs) < lengths[:, None]] = np.fromiter(
+        (item for items in batch_recs for item in items),
+        dtype='int64', count=int(lengths.sum())
+    )
+
+    return recs, np.array([SOURCES.index(source) for source in sources])
+
+
+def get_last_items(
+    events: pd.DataFrame,
+    user_ids: np.ndarray
+) -> list[list[int]]:
+    """
+    Get N_LAST_ITEMS last items of each user in chronological order
+    (the latest is the last, as in requests to the service) from events
+    table (user_id, item_id, timestamp).
+    """
+
+    events = events[events['user_id'].isin(user_ids)].sort_values(
+        by=['user_id', 'timestamp'], kind='stable'
+    )
+    rank = events.groupby('user_id').cumcount(ascending=False).to_numpy()
+    events = events[rank < N_LAST_ITEMS]
+
+    last_items = [[] for _ in user_ids]
+    for pos, item_id in zip(
+        np.searchsorted(user_ids, events['user_id'].to_numpy()).tolist(),
+        events['item_id'].tolist()
+    ):
+        last_items[pos].append(item_id)
+
+    return last_items
+
+
+def evaluate_recs():
+    """
+    Evaluate recommendations the service gives to users who added items to
+    cart in the test period (as of the train/test split date: last items
+    are taken from the train period): precision@K, recall@K and
+    coverage@K as in notebooks/experiments.ipynb, overall and by the source
+    of personal part of recs.
+    """
+
+    k_precision = params['EVAL_K_PRECISION_RECALL']
+    k_coverage = params['EVAL_K_COVERAGE']
+    batch_size = params['EVAL_BATCH_SIZE']
+
+    assert k_precision > 0 and k_coverage > 0 and batch_size > 0
+
+    # Хендлер сервиса с данными из бандла
+    handler = get_handler()
+
+    # 'Ground truth' - добавления товаров в корзину в тестовый период
+    events_test = pd.read_parquet(
+        'cache/events_test.parquet', columns=['user_id', 'event', 'item_id']
+    )
+    events_test = (
+        events_test[events_test['event'] == 'addtocart']
+        .drop_duplicates(subset=['user_id', 'item_id'])
+    )
+    user_ids = np.unique(events_test['user_id'].to_numpy(dtype='int64'))
+
+    # Последние товары пользователей на дату разделения выборок
+    last_items = get_last_items(
+        pd.read_parquet(
+            'cache/events_train.parquet',
+            columns=['user_id', 'item_id', 'timestamp']
+        ),
+        user_ids
+    )
+
+    # Пары (user_id, item_id) 'ground truth', упакованные в int64
+    # NB: идентификаторы - int32
+    n_item_keys = 2 ** 31
+    gt_keys = np.sort(
+        events_test['user_id'].to_numpy(dtype='int64') * n_item_keys
+        + events_test['item_id'].to_numpy(dtype='int64')
+    )
+    n_gt = np.bincount(
+        np.searchsorted(user_ids, events_test['user_id'].to_numpy()),
+        minlength=len(user_ids)
+    )
+
+    precision = np.zeros(len(user_ids))
+    recall = np.zeros(len(user_ids))
+    has_recs = np.zeros(len(user_ids), dtype=bool)
+    sources = np.zeros(len(user_ids), dtype='int8')
+    covered = np.zeros(0, dtype='int64')
+
+    for start in range(0, len(user_ids), batch_size):
+        batch = slice(start, start + batch_size)
+
+        # Рекомендации для precision/recall: запрос с n_recs = K
+        recs, sources[batch] = get_recs(
+            handler, user_ids[batch], last_items[batch], k_precision
+        )
+        valid = recs != MISSING
+        keys = user_ids[batch][:, None] * n_item_keys + recs
+        pos = np.minimum(np.searchsorted(gt_keys, keys), len(gt_keys) - 1)
+        hits = ((gt_keys[pos] == keys) & valid).sum(axis=1)
+        n_recs = valid.sum(axis=1)
+
+        has_recs[batch] = n_recs > 0
+        precision[batch] = hits / np.maximum(n_recs, 1)
+        recall[batch] = hits / n_gt[batch]
+
+        # Рекомендации для coverage: запрос с n_recs = K
+        recs, _ = get_recs(
+            handler, user_ids[batch], last_items[batch], k_coverage
+        )
+        covered = np.union1d(covered, recs[recs != MISSING])
+
+        print(f'Evaluated {min(start + batch_size, len(user_ids))} of '
+              f'{len(user_ids)} users')
+
+    # Метрики считаем по пользователям, получившим рекомендации, покрытие -
+    # по всем товарам каталога (как в notebooks/experiments.ipynb)
+    n_items = pd.read_parquet(
+        'recs/items_train.parquet', columns=['item_id']
+    )['item_id'].nunique()
+
+    def get_metrics(mask):
+        mask = mask & has_recs
+        return {
+            'n_users': int(mask.sum()),
+            f'precision_at_{k_precision}_in_percent': (
+                float(precision[mask].mean() * 100) if mask.any() else 0.
+            ),
+            f'recall_at_{k_precision}_in_percent': (
+                float(recall[mask].mean() * 100) if mask.any() else 0.
+            )
+        }
+
+    metrics = {
+        **get_metrics(np.ones(len(user_ids), dtype=bool)),
+        f'coverage_at_{k_coverage}_in_percent': len(covered) / n_items * 100,
+        'by_source': {
+            name: get_metrics(sources == i)
+            for i, name in enumerate(SOURCES)
+        }
+    }
+
+    Path('metrics').mkdir(exist_ok=True)
+    with open('metrics/evaluation.json', 'w') as f:
+        json.dump(metrics, f, indent=4)
+
+    print(json.dumps(metrics, indent=4))
+
+
+if __name__ == '__main__':
+    evaluate_recs()
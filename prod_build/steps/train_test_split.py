@@ -1,56 +1,224 @@
+import json
+from pathlib import Path
+
 import dvc.api
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from etl_utils import (ParquetChunkWriter, list_partition_files,
+                       read_by_partition, write_json)
 
 build_date = dvc.api.params_show('build_date.yaml')
+params = dvc.api.params_show()
+
+# Столбцы таблицы событий
+EVENTS_COLUMNS = [
+    'timestamp', 'user_id', 'event', 'item_id', 'transaction_id'
+]
+
+# Столбцы таблицы товаров
+ITEMS_COLUMNS = [
+    'timestamp', 'item_id', 'category_id', 'parents', 'top_cat_id'
+]
 
 
 def train_test_split():
-    """Split events/items tables to train/test."""
+    """
+    Split events/items tables to train/test.
+
+    Date-partitioned events/items datasets are read partition by partition
+    with filters pushed down to the parquet reader, so the full history is
+    never loaded into memory.
+    """
 
     assert build_date['build_date']
+    assert isinstance(params['ETL_INCREMENTAL'], bool)
 
     # Временная точка разделения выборок
     SPLIT_DATETIME = pd.to_datetime(build_date["build_date"])
 
     print(f'Train/test split date: {SPLIT_DATETIME}')
 
-    # Загружаем предобработанные данные
-    items = pd.read_parquet('cache/items.parquet')
-    events = pd.read_parquet('cache/events.parquet')
-
-    # Сортируем по времени
-    items.sort_values('timestamp', ignore_index=True, inplace=True)
-    events.sort_values('timestamp', ignore_index=True, inplace=True)
-
-    # Разбиваем события на обучающую и тестовую выборки
-    events_train = events[events['timestamp'] < SPLIT_DATETIME]
-    events_test = events[events['timestamp'] >= SPLIT_DATETIME]
-
-    # Каталог товаров для обучения модели
-    items_train = (
-        items[items['timestamp'] < SPLIT_DATETIME]
-        .sort_values(by='timestamp', ascending=True)
-        .groupby('item_id')
-        .tail(1)  # оставляем только последнее значение признака
-        .reset_index(drop=True)
+    split_day = SPLIT_DATETIME.strftime('%Y-%m-%d')
+    timestamp = ds.field('timestamp')
+
+    # Каталог товаров для обучения модели: последнее (до точки разделения)
+    # значение признаков для каждого товара
+    items_train = update_items_latest(
+        'cache/items', 'cache/items_latest', SPLIT_DATETIME,
+        incremental=params['ETL_INCREMENTAL']
+    )
+
+    # Идентификаторы всех товаров каталога
+    items_files = list_partition_files('cache/items')
+    catalog_item_ids = np.unique(np.concatenate([
+        items['item_id'].unique()
+        for items in read_by_partition(
+            'cache/items', list(items_files), columns=['item_id']
+        )
+    ]))
+
+    events_files = list_partition_files('cache/events')
+
+    # Обучающая выборка: события до точки разделения (читаем только
+    # партиции до даты разделения включительно)
+    # NB: удалим события для товаров, которые отсутствуют в 'обучающем'
+    # какталоге товаров, т.е. свойства которых неизвестны на момент
+    # обучения модели
+    write_events(
+        'cache/events',
+        [file for file, date in events_files.items() if date <= split_day],
+        row_filter=timestamp < SPLIT_DATETIME.to_datetime64(),
+        item_ids=items_train['item_id'].to_numpy(),
+        path='cache/events_train.parquet'
     )
 
-    # Удалим из обучающей выборки события для товаров, которые отсутствуют
-    # в 'обучающем' какталоге товаров, т.е. свойства которых неизвестны
-    # на момент обучения модели
-    events_train = (
-        events_train[
-            events_train['item_id']
-            .isin(items_train['item_id'].drop_duplicates())
-        ]
-        .reset_index(drop=True)
+    # Тестовая выборка: события после точки разделения
+    # NB: удалим события для товаров, отсутствующих в каталоге items
+    write_events(
+        'cache/events',
+        [file for file, date in events_files.items() if date >= split_day],
+        row_filter=timestamp >= SPLIT_DATETIME.to_datetime64(),
+        item_ids=catalog_item_ids,
+        path='cache/events_test.parquet'
     )
 
     # Сохраняем таблицы локально
-    events_train.to_parquet('cache/events_train.parquet')
-    events_test.to_parquet('cache/events_test.parquet')
     items_train.to_parquet('recs/items_train.parquet')
 
 
+def write_events(
+    events_path: str,
+    files: list[str],
+    row_filter: ds.Expression,
+    item_ids: np.ndarray,
+    path: str
+):
+    """
+    Write events from given files of the events dataset matching the filter
+    and having given item_ids to a .parquet file sorted by timestamp,
+    one partition (date) at a time.
+    """
+
+    # Маска допустимых item_id: проверка принадлежности за O(1) на событие
+    # NB: быстрее фильтра isin, множество значений которого строится
+    # заново при чтении каждой партиции. При пустом item_ids (например,
+    # в окне дат нет товаров) маска из одного False отбрасывает все
+    # события - записывается пустая таблица
+    item_mask = np.zeros(item_ids.max(initial=0) + 1, dtype=bool)
+    item_mask[item_ids] = True
+
+    # NB: результат предыдущего запуска удаляем - файл ниже пишется заново
+    Path(path).unlink(missing_ok=True)
+
+    with ParquetChunkWriter(path) as writer:
+        for events in read_by_partition(
+            events_path, files, EVENTS_COLUMNS, row_filter
+        ):
+            event_item_ids = events['item_id'].to_numpy()
+            events = events[
+                item_mask[np.minimum(event_item_ids, len(item_mask) - 1)]
+                & (event_item_ids < len(item_mask))
+            ]
+            writer.write(events.sort_values('timestamp', kind='stable'))
+
+        print(f'{path}: {writer.n_rows} events')
+
+    # Нет партиций в окне дат - пустая таблица со схемой датасета
+    if not Path(path).exists():
+        pq.write_table(
+            ds.dataset(events_path, format='parquet').schema.empty_table()
+            .select(EVENTS_COLUMNS),
+            path
+        )
+
+
+def update_items_latest(
+    items_path: str,
+    latest_path: str,
+    split_datetime: pd.Timestamp,
+    incremental: bool = True
+) -> pd.DataFrame:
+    """
+    Get the latest (before split_datetime) row for each item of the
+    date-partitioned items dataset.
+
+    The result is kept at latest_path along with the list of dataset files
+    already merged into it. In incremental mode only new files (and files
+    of partitions between the previous and current split dates) are read
+    and merged into the previous result, the result is recalculated from
+    scratch if split date moved back or merged files are missing (the
+    items dataset was rebuilt). Files are merged one partition at a time,
+    so memory is bounded by the number of items, not by the history size.
+    """
+
+    latest_path = Path(latest_path)
+    state_path = latest_path / 'state.json'
+    files = list_partition_files(items_path)
+    split_day = split_datetime.strftime('%Y-%m-%d')
+
+    state = None
+    if incremental and state_path.exists():
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except json.JSONDecodeError:
+            state = None
+        if state is not None and (
+            pd.Timestamp(state['split_datetime']) > split_datetime
+            or not set(state['merged_files']) <= set(files)
+        ):
+            state = None
+
+    if state is None:
+        print('Calculating latest item properties from scratch')
+        state = {'merged_files': []}
+        latest = None
+    else:
+        print('Updating latest item properties incrementally')
+        latest = pd.read_parquet(latest_path / 'items.parquet')
+
+    # Файлы партиций до точки разделения, еще не учтенные в результате
+    new_files = [
+        file for file, date in files.items()
+        if date <= split_day and file not in state['merged_files']
+    ]
+
+    print(f'Merging {len(new_files)} new items dataset files')
+
+    for items in read_by_partition(
+        items_path, new_files, ITEMS_COLUMNS,
+        row_filter=ds.field('timestamp') < split_datetime.to_datetime64()
+    ):
+        # Оставляем только последнее значение признаков каждого товара
+        latest = (
+            pd.concat([latest, items], ignore_index=True)
+            .sort_values(by='timestamp', kind='stable')
+            .groupby('item_id')
+            .tail(1)
+        )
+
+    assert latest is not None, 'No items before split date'
+
+    latest = latest.sort_values(
+        by='timestamp', kind='stable', ignore_index=True
+    )
+
+    # Партиции, целиком предшествующие точке разделения, учтены полностью
+    # NB: партиция даты разделения будет прочитана повторно при следующем
+    # запуске (повторное объединение тех же строк не меняет результат)
+    state['merged_files'] += [
+        file for file in new_files if files[file] < split_day
+    ]
+    state['split_datetime'] = split_datetime.isoformat()
+
+    latest_path.mkdir(parents=True, exist_ok=True)
+    latest.to_parquet(latest_path / 'items.parquet')
+    write_json(str(state_path), state)
+
+    return latest
+
+
 if __name__ == '__main__':
     train_test_split()
@@ -0,0 +1,219 @@
+import importlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from dvc.repo import Repo
+
+# Шаги пайплайна запускаются как скрипты из prod_build/steps
+sys.path.append(str(Path(__file__).parents[1] / 'steps'))
+from etl_utils import (STATE_FILE, IncrementalDataset,  # noqa: E402
+                       list_partition_files, read_by_partition)
+
+# Столбцы синтетической таблицы событий
+EVENTS_COLUMNS = ['timestamp', 'visitorid', 'event', 'itemid']
+
+# Столбцы синтетической таблицы товаров
+ITEMS_COLUMNS = [
+    'timestamp', 'item_id', 'category_id', 'parents', 'top_cat_id'
+]
+
+
+def make_events(n_rows: int, seed: int) -> pd.DataFrame:
+    """Synthetic events table spread over 10 days from 2015-08-25."""
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2015-08-25').value // 10 ** 6
+    return pd.DataFrame({
+        'timestamp': start + rng.choice(
+            10 * 24 * 3600 * 1000, size=n_rows, replace=False
+        ),
+        'visitorid': rng.integers(0, 50, size=n_rows),
+        'event': rng.choice(['view', 'addtocart', 'transaction'], n_rows),
+        'itemid': rng.integers(0, 30, size=n_rows)
+    }, columns=EVENTS_COLUMNS)
+
+
+def append_csv(path: Path, rows: pd.DataFrame):
+    """Append rows to a .csv file (with header if the file is new)."""
+
+    rows.to_csv(path, mode='a', header=not path.exists(), index=False)
+
+
+def build_dataset(
+    path: Path,
+    source: Path,
+    incremental: bool = True,
+    fail_after_rows: int | None = None
+):
+    """Update dataset from the source as ETL steps do (in small chunks)."""
+
+    with IncrementalDataset(
+        str(path), sources=[str(source)], incremental=incremental
+    ) as dataset:
+        for chunk in dataset.read_new_rows(str(source), chunksize=7):
+            dataset.write(chunk.assign(
+                timestamp=pd.to_datetime(chunk['timestamp'], unit='ms')
+            ))
+            if fail_after_rows is not None and (
+                dataset.n_rows >= fail_after_rows
+            ):
+                raise RuntimeError('Step failed')
+
+
+def read_dataset(path: Path) -> pd.DataFrame:
+    """Read all rows of a dataset in a canonical order."""
+
+    files = list_partition_files(str(path))
+    return (
+        pd.concat(read_by_partition(str(path), list(files), EVENTS_COLUMNS))
+        .sort_values(by=['timestamp', 'visitorid', 'itemid'])
+        .reset_index(drop=True)
+    )
+
+
+def assert_same_as_rebuild(path: Path, source: Path, tmp_path: Path):
+    """Check that dataset equals the dataset rebuilt from scratch."""
+
+    build_dataset(tmp_path / 'rebuilt', source, incremental=False)
+    pd.testing.assert_frame_equal(
+        read_dataset(path), read_dataset(tmp_path / 'rebuilt')
+    )
+
+
+def test_incremental_matches_rebuild(tmp_path):
+    source = tmp_path / 'events.csv'
+    events = make_events(100, seed=0)
+
+    # Два запуска: вторая часть строк дописывается в исходную таблицу
+    append_csv(source, events[:60])
+    build_dataset(tmp_path / 'events', source)
+    append_csv(source, events[60:])
+    build_dataset(tmp_path / 'events', source)
+
+    assert_same_as_rebuild(tmp_path / 'events', source, tmp_path)
+    assert len(read_dataset(tmp_path / 'events')) == len(events)
+
+
+def test_rewritten_source_is_rebuilt(tmp_path):
+    source = tmp_path / 'events.csv'
+
+    append_csv(source, make_events(60, seed=0))
+    build_dataset(tmp_path / 'events', source)
+
+    # Исходная таблица перезаписана (не только дописана)
+    source.unlink()
+    append_csv(source, make_events(80, seed=1))
+    build_dataset(tmp_path / 'events', source)
+
+    assert_same_as_rebuild(tmp_path / 'events', source, tmp_path)
+
+
+def test_failed_run_is_cleaned_up(tmp_path):
+    source = tmp_path / 'events.csv'
+    events = make_events(100, seed=0)
+
+    append_csv(source, events[:60])
+    build_dataset(tmp_path / 'events', source)
+    append_csv(source, events[60:])
+
+    # Запуск, упавший после записи части новых строк
+    with pytest.raises(RuntimeError):
+        build_dataset(tmp_path / 'events', source, fail_after_rows=20)
+
+    build_dataset(tmp_path / 'events', source)
+
+    assert_same_as_rebuild(tmp_path / 'events', source, tmp_path)
+
+
+def test_broken_state_is_rebuilt(tmp_path):
+    source = tmp_path / 'events.csv'
+    events = make_events(100, seed=0)
+
+    append_csv(source, events[:60])
+    build_dataset(tmp_path / 'events', source)
+    append_csv(source, events[60:])
+
+    # Файл состояния, запись которого была прервана
+    (tmp_path / 'events' / STATE_FILE).write_text('{"fingerprint": {')
+    build_dataset(tmp_path / 'events', source)
+
+    assert_same_as_rebuild(tmp_path / 'events', source, tmp_path)
+
+
+def test_incomplete_last_line(tmp_path):
+    source = tmp_path / 'events.csv'
+    append_csv(source, make_events(60, seed=0))
+    source.write_bytes(source.read_bytes().rstrip(b'\n'))
+
+    # Полная пересборка читает файл, но не сохраняет смещение
+    build_dataset(tmp_path / 'events', source, incremental=False)
+    assert len(read_dataset(tmp_path / 'events')) == 60
+    state = (tmp_path / 'events' / STATE_FILE).read_text()
+    assert str(source) not in state
+
+    # Инкрементальный режим требует завершенной последней строки
+    with pytest.raises(AssertionError, match='Incomplete last line'):
+        build_dataset(tmp_path / 'events', source)
+
+
+@pytest.fixture
+def train_test_split(tmp_path, monkeypatch):
+    """Step module imported in a dvc project with its params."""
+
+    Repo.init(str(tmp_path), no_scm=True)
+    (tmp_path / 'params.yaml').write_text('ETL_INCREMENTAL: True\n')
+    (tmp_path / 'build_date.yaml').write_text('build_date: "2015-09-01"\n')
+    monkeypatch.chdir(tmp_path)
+
+    return importlib.import_module('train_test_split')
+
+
+def test_items_latest_matches_rebuild(tmp_path, train_test_split):
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp('2015-08-25')
+    items = pd.DataFrame({
+        'timestamp': start + pd.to_timedelta(
+            rng.choice(10 * 24 * 3600, size=200, replace=False), unit='s'
+        ),
+        'item_id': rng.integers(0, 40, size=200).astype('int32'),
+        'category_id': rng.integers(0, 10, size=200).astype('int32'),
+    }, columns=ITEMS_COLUMNS[:3])
+    items['parents'] = items['category_id'].astype(str)
+    items['top_cat_id'] = items['category_id'] % 3
+
+    def write_items(rows: pd.DataFrame):
+        with IncrementalDataset(
+            'items', sources=[], incremental=True
+        ) as dataset:
+            dataset.write(rows)
+
+    # Два запуска: новые файлы датасета и сдвиг точки разделения вперед
+    write_items(items[:120])
+    train_test_split.update_items_latest(
+        'items', 'latest', pd.Timestamp('2015-08-29 12:00')
+    )
+    write_items(items[120:])
+    split_datetime = pd.Timestamp('2015-09-01 06:00')
+    latest = train_test_split.update_items_latest(
+        'items', 'latest', split_datetime
+    )
+
+    rebuilt = train_test_split.update_items_latest(
+        'items', 'rebuilt', split_datetime, incremental=False
+    )
+    expected = (
+        items[items['timestamp'] < split_datetime]
+        .sort_values(by='timestamp')
+        .groupby('item_id')
+        .tail(1)
+    )
+
+    for result in (latest, rebuilt):
+        pd.testing.assert_frame_equal(
+            result.sort_values(by='item_id', ignore_index=True),
+            expected.sort_values(by='item_id', ignore_index=True),
+            check_dtype=False
+        )
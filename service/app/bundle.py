@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+# Версия формата бандла рекомендаций
+BUNDLE_FORMAT_VERSION = 2
+
+# Файл с метаданными бандла
+META_FILE = 'meta.json'
+
+
+def save_bundle(path: str, stores: dict[str, Any], meta: dict):
+    """
+    Save serving bundle: a directory with one .npy file per array of each
+    store (named `<store name>.<array name>.npy`, see `to_arrays` methods
+    of stores) and a json file with metadata.
+
+    The bundle is written to a new versioned directory next to `path`
+    (`.<name>.<suffix>`), then `path` - a symlink to the current version -
+    is atomically replaced with a symlink to the new one, so readers never
+    see a partially written or missing bundle. The previous version is kept
+    for readers which resolved the symlink before the swap, older ones are
+    removed (memory-mapped files stay valid for processes using them).
+    The bundle is expected to have a single writer.
+    """
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    version_path = Path(
+        tempfile.mkdtemp(prefix=f'.{path.name}.', dir=path.parent)
+    )
+    os.chmod(version_path, 0o755)
+    link_path = version_path.with_name(f'{version_path.name}.link')
+
+    arrays = {
+        f'{store_name}.{name}': array
+        for store_name, store in stores.items()
+        for name, array in store.to_arrays().items()
+    }
+
+    try:
+        for name, array in arrays.items():
+            np.save(version_path / f'{name}.npy', np.ascontiguousarray(array))
+
+        with open(version_path / META_FILE, 'w') as f:
+            json.dump(
+                {
+                    **meta,
+                    'format_version': BUNDLE_FORMAT_VERSION,
+                    'arrays': sorted(arrays)
+                },
+                f,
+                indent=2
+            )
+
+        # Симлинк на новую версию создаем под временным именем и атомарно
+        # подменяем им текущий (NB: путь в симлинке относительный, бандл
+        # можно перемещать вместе с родительской директорией)
+        os.symlink(version_path.name, link_path)
+
+        old_version_path = None
+        if path.is_symlink():
+            old_version_path = path.parent / os.readlink(path)
+        elif path.exists():
+            # Бандл прежнего формата (обычная директория, например после
+            # dvc checkout) перемещаем в сторону: читатели видят отсутствие
+            # бандла только между двумя переименованиями
+            old_version_path = Path(tempfile.mkdtemp(
+                prefix=f'.{path.name}.old.', dir=path.parent
+            ))
+            os.replace(path, old_version_path / path.name)
+
+        os.replace(link_path, path)
+
+    except BaseException:
+        if link_path.is_symlink():
+            link_path.unlink()
+        shutil.rmtree(version_path, ignore_errors=True)
+        raise
+
+    # Удаляем версии старше предыдущей (и остатки прерванных записей):
+    # предыдущую оставляем для читателей, разрешивших симлинк до подмены
+    for stale_path in path.parent.glob(f'.{path.name}.*'):
+        if stale_path in (version_path, old_version_path):
+            continue
+        if stale_path.is_dir() and not stale_path.is_symlink():
+            shutil.rmtree(stale_path, ignore_errors=True)
+        else:
+            stale_path.unlink(missing_ok=True)
+
+
+def load_bundle(
+    path: str,
+    mmap: bool = True
+) -> tuple[dict[str, dict[str, np.ndarray]], dict]:
+    """
+    Load serving bundle arrays grouped by store, i.e.
+    {store name: {array name: array}}, and metadata.
+
+    With mmap=True arrays are memory-mapped read-only: loading takes
+    milliseconds and physical memory (page cache) is shared among
+    all processes which attach the same bundle.
+    """
+
+    # NB: симлинк разрешаем один раз, чтобы метаданные и массивы были
+    # прочитаны из одной версии бандла, даже если он подменяется
+    path = Path(path).resolve()
+
+    with open(path / META_FILE, 'r') as f:
+        meta = json.load(f)
+
+    if meta.get('format_version') != BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            f'Unsupported bundle format version {meta.get("format_version")}'
+            f' (expected {BUNDLE_FORMAT_VERSION}) in {path}'
+        )
+
+    arrays = {
+        name: np.load(path / f'{name}.npy', mmap_mode='r' if mmap else None)
+        for name in meta['arrays']
+    }
+
+    # NB: срезы np.memmap заметно медленнее срезов обычных массивов,
+    # поэтому используем ndarray-представления (view) тех же данных
+    stores = {}
+    for full_name, array in arrays.items():
+        store_name, name = full_name.split('.', 1)
+        stores.setdefault(store_name, {})[name] = (
+            array.view(np.ndarray) if mmap else array
+        )
+
+    return stores, meta
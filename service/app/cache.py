@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+from prometheus_client import Counter
+
+
+class RecsCache:
+    """
+    Bounded in-process LRU cache of recommendations with entries expiring
+    after a given time to live. Thread-safe.
+
+    Attributes:
+        - **max_size** - max number of cached entries, the least recently
+        used entry is evicted when the limit is exceeded
+
+        - **ttl** - time to live (sec) of cached entries
+
+        - **metric_hits** - counter of cache hits
+
+        - **metric_misses** - counter of cache misses
+
+        - **metric_evictions** - counter of evicted entries labeled with
+        eviction reason (size | ttl | clear)
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        metric_hits: Counter,
+        metric_misses: Counter,
+        metric_evictions: Counter
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metric_hits = metric_hits
+        self.metric_misses = metric_misses
+        self.metric_evictions = metric_evictions
+
+        # key -> (время истечения, рекомендации), порядок - от давно
+        # использованных к недавно использованным
+        self._entries: OrderedDict[Hashable, tuple[float, tuple[int, ...]]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> list[int] | None:
+        """Get cached recommendations, None if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                self.metric_evictions.labels(reason='ttl').inc()
+                entry = None
+
+            if entry is None:
+                self.metric_misses.inc()
+                return None
+
+            self._entries.move_to_end(key)
+
+        self.metric_hits.inc()
+
+        # NB: отдаем копию, чтобы вызывающий код не мог изменить кэш
+        return list(entry[1])
+
+    def put(self, key: Hashable, recs: list[int]):
+        """Cache recommendations evicting the least recently used entry."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, tuple(recs))
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.metric_evictions.labels(reason='size').inc()
+
+    def clear(self):
+        """Drop all cached entries (e.g. when underlying data is reloaded)."""
+
+        with self._lock:
+            n_entries = len(self._entries)
+            self._entries.clear()
+
+        self.metric_evictions.labels(reason='clear').inc(n_entries)
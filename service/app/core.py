@@ -1,15 +1,37 @@
 import logging
+import os
+import threading
+import time
 from itertools import zip_longest
+from typing import NamedTuple
 
+import numpy as np
 import pandas as pd
+from bundle import META_FILE, load_bundle, save_bundle
+from cache import RecsCache
 from pydantic import BaseModel, Field, NonNegativeInt, PositiveInt
+from stores import (ItemCategoryMap, ItemFactorsStore, ItemNeighboursStore,
+                    PersonalRecsStore, TopPopularStore, as_id_array)
+from timing import HandlerMetrics, PhaseTimer
+
+# Значения настроек хендлера по умолчанию (в т.ч. при создании хендлера
+# по переменным окружения сервиса, см. RecSysHandler.from_env)
+DEFAULT_TOP_POPULAR_MAX_N = 100
+DEFAULT_FOLD_IN_MAX_CANDIDATES = 20000
+
+# Пользователь в ключе кэша рекомендаций для всех пользователей без
+# персональных рекомендаций (NB: user_id запроса неотрицательный)
+COLD_USER_KEY = -1
 
 
 class RecSysRequest(BaseModel):
     """Pydantic model of incoming recommendations request."""
 
     user_id: NonNegativeInt = Field(..., description='User ID')
-    n_recs: PositiveInt = Field(10, description='Number of recommendations')
+    n_recs: PositiveInt = Field(
+        10, description='Number of recommendations, at most TOP_POPULAR_MAX_N '
+        'of the service (100 by default), larger values are rejected with 422'
+    )
     last_items: list[NonNegativeInt] = Field(
         [], description='Ids of last items user interacted with in '
         'chronological order (the latest is the last)'
@@ -24,10 +46,66 @@ class RecSysResponse(BaseModel):
     )
 
 
+class RecSysData(NamedTuple):
+    """
+    Immutable snapshot of data used to build recommendations.
+
+    Attributes:
+        - **item_cats** - item to category mapping
+
+        - **top_popular** - top-popular items, global and per category
+
+        - **personal_recs** - pre-calculated personal recommendations
+
+        - **item_factors** - ALS item factors for online fold-in of users
+        without personal recommendations (empty if fold-in is disabled)
+
+        - **item_neighbours** - pre-calculated similar items (empty if
+        item-to-item recs are disabled)
+
+        - **version** - version of loaded artifacts: the latest
+        modification time of artifact files (unix timestamp)
+    """
+
+    item_cats: ItemCategoryMap
+    top_popular: TopPopularStore
+    personal_recs: PersonalRecsStore
+    item_factors: ItemFactorsStore
+    item_neighbours: ItemNeighboursStore
+    version: float
+
+
+def interleave_unique(lists: list[list[int]], n_recs: int) -> list[int]:
+    """
+    Merge lists by interleaving their elements (the first from the first
+    list, the first from the second list, ..., the second from the first
+    list etc.), skipping duplicates and stopping as soon as n_recs unique
+    items are collected.
+    """
+
+    merged = []
+    seen = set()
+
+    for items_tuple in zip_longest(*lists):
+        for item in items_tuple:
+            if item is None or item in seen:
+                continue
+            merged.append(item)
+            if len(merged) == n_recs:
+                return merged
+            seen.add(item)
+
+    return merged
+
+
 class RecSysHandler:
     """
     Main handler class for recommendations retreival.
 
+    All loaded data is kept in a single immutable RecSysData snapshot, which
+    is replaced atomically on reload: in-flight requests keep using the
+    snapshot they started with.
+
     Attributes:
         - **path_recs_top_popular** - path to a .parquet file with
         pre-calculated non-personalised recommendations: a table with columns
@@ -39,33 +117,243 @@ class RecSysHandler:
 
         - **path_items_train** - path to a .parquet file with items catalog
         containing columns (item_id, category_id)
+
+        - **top_popular_max_n** - max number of top-popular items kept in
+        memory per category (and globally), i.e. the max length of online
+        recommendations and the max n_recs of a request (in bundle mode
+        must match the value the bundle is built with)
+
+        - **path_recs_bundle** - optional path to a serving bundle (see
+        `export_bundle`), if set data is memory-mapped from the bundle
+        instead of loading .parquet files. The .parquet files are loaded
+        only if the bundle is missing on the first load, later a missing
+        bundle fails the reload and current data is kept
+
+        - **recs_cache** - optional cache of `get_recs` results, cleared
+        when data is (re)loaded
+
+        - **path_item_factors** - optional path to a .parquet file with ALS
+        item factors: a table with columns (item_id, factors) and model
+        parameters (regularization, confidence) in table attrs. If set,
+        users without personal recs get personal recommendations folded in
+        from their last items online (in bundle mode factors are taken from
+        the bundle, the path only enables fold-in)
+
+        - **fold_in_max_candidates** - max number of items (the most
+        popular ones) scored for fold-in recommendations, bounds the cost
+        of a request for a user without personal recs
+
+        - **path_item_neighbours** - optional path to a .parquet file with
+        pre-calculated item-to-item recommendations: a table with columns
+        (item_id, neighbour_id, score). If set, items similar to the last
+        items are blended into recommendations (in bundle mode similar items
+        are taken from the bundle, the path only enables them)
+
+        - **handler_metrics** - optional sampled latency metrics of
+        `get_recs` / `get_recs_batch` phases
     """
 
     def __init__(
         self,
         path_recs_top_popular: str,
         path_recs_personal: str,
-        path_items_train: str
+        path_items_train: str,
+        top_popular_max_n: int = DEFAULT_TOP_POPULAR_MAX_N,
+        path_recs_bundle: str | None = None,
+        recs_cache: RecsCache | None = None,
+        path_item_factors: str | None = None,
+        path_item_neighbours: str | None = None,
+        handler_metrics: HandlerMetrics | None = None,
+        fold_in_max_candidates: int = DEFAULT_FOLD_IN_MAX_CANDIDATES
     ):
         self.path_recs_top_popular = path_recs_top_popular
         self.path_recs_personal = path_recs_personal
         self.path_items_train = path_items_train
+        self.top_popular_max_n = top_popular_max_n
+        self.path_recs_bundle = path_recs_bundle
+        self.recs_cache = recs_cache
+        self.path_item_factors = path_item_factors
+        self.path_item_neighbours = path_item_neighbours
+        self.handler_metrics = handler_metrics
+        self.fold_in_max_candidates = fold_in_max_candidates
         self.logger = logging.getLogger('recsys_service')
 
+        # Текущий снимок данных и длительность его загрузки (сек)
+        self._data: RecSysData | None = None
+        self.load_duration: float | None = None
+
+        # Блокировка, исключающая одновременные перезагрузки данных
+        self._reload_lock = threading.Lock()
+
+    @classmethod
+    def from_env(
+        cls,
+        base_dir: str | None = None,
+        **overrides
+    ) -> 'RecSysHandler':
+        """
+        Create handler configured by environment variables of the service
+        (see .env_service): PATH_RECS_TOP_POPULAR, PATH_RECS_PERSONAL,
+        PATH_ITEMS_TRAIN, TOP_POPULAR_MAX_N, PATH_RECS_BUNDLE,
+        PATH_ALS_ITEM_FACTORS, PATH_ITEM_NEIGHBOURS and
+        FOLD_IN_MAX_CANDIDATES (empty paths are unset).
+
+        Relative paths are resolved against base_dir (if given), keyword
+        arguments override the settings and set other attributes.
+        """
+
+        def path(name: str) -> str | None:
+            value = os.getenv(name)
+            if not value:
+                return None
+            return os.path.join(base_dir, value) if base_dir else value
+
+        settings = {
+            'path_recs_top_popular': path('PATH_RECS_TOP_POPULAR'),
+            'path_recs_personal': path('PATH_RECS_PERSONAL'),
+            'path_items_train': path('PATH_ITEMS_TRAIN'),
+            'top_popular_max_n': int(
+                os.getenv('TOP_POPULAR_MAX_N', DEFAULT_TOP_POPULAR_MAX_N)
+            ),
+            'path_recs_bundle': path('PATH_RECS_BUNDLE'),
+            'path_item_factors': path('PATH_ALS_ITEM_FACTORS'),
+            'path_item_neighbours': path('PATH_ITEM_NEIGHBOURS'),
+            'fold_in_max_candidates': int(os.getenv(
+                'FOLD_IN_MAX_CANDIDATES', DEFAULT_FOLD_IN_MAX_CANDIDATES
+            ))
+        }
+
+        return cls(**{**settings, **overrides})
+
+    @property
+    def data_version(self) -> float | None:
+        """Version (artifacts modification timestamp) of loaded data."""
+
+        return self._data.version if self._data is not None else None
+
+    def _use_bundle(self) -> bool:
+        """Check if data is to be loaded from an (existing) serving bundle."""
+
+        return bool(self.path_recs_bundle) and os.path.exists(
+            os.path.join(self.path_recs_bundle, META_FILE)
+        )
+
+    def artifact_paths(self) -> list[str]:
+        """
+        Get paths of artifact files the data is loaded from (the bundle
+        metadata file if the bundle path is set, even if it is missing).
+        """
+
+        if self.path_recs_bundle:
+            return [os.path.join(self.path_recs_bundle, META_FILE)]
+
+        return self._parquet_paths()
+
+    def _parquet_paths(self) -> list[str]:
+        """Get paths of .parquet files the data is loaded from."""
+
+        return [
+            self.path_items_train,
+            self.path_recs_top_popular,
+            self.path_recs_personal
+        ] + [
+            path
+            for path in (self.path_item_factors, self.path_item_neighbours)
+            if self._optional_exists(path)
+        ]
+
+    def _optional_exists(self, path: str | None) -> bool:
+        """Check if an optional .parquet file is set and exists."""
+
+        return bool(path) and os.path.exists(path)
+
     def load_data(self):
-        """Load pre-calculated offline recommendations to memory."""
+        """
+        Load pre-calculated offline recommendations to memory, validate
+        them and atomically replace currently used data (if any).
+        """
+
+        t_start = time.perf_counter()
+
+        # Если задан путь к бандлу, его отсутствие означает, что бандл еще
+        # не готов (например, пересобирается): .parquet файлы загружаются
+        # только при первом запуске, иначе каждый процесс держал бы свою
+        # копию данных вместо общего бандла - оставляем текущие данные
+        use_bundle = self._use_bundle()
+        if self.path_recs_bundle and not use_bundle:
+            if self._data is not None:
+                raise FileNotFoundError(
+                    f'Serving bundle not found at {self.path_recs_bundle}, '
+                    'keeping current data'
+                )
+            self.logger.warning(
+                f'Serving bundle not found at {self.path_recs_bundle}, '
+                'loading .parquet files'
+            )
+
+        # Версия определяется до загрузки: если файлы изменятся во время
+        # загрузки, следующая проверка обнаружит изменение
+        version = max(
+            os.path.getmtime(path)
+            for path in (
+                self.artifact_paths() if use_bundle else self._parquet_paths()
+            )
+        )
+
+        if use_bundle:
+            data = self._load_bundle(version)
+        else:
+            data = self._load_parquet(version)
+
+        self._validate(data)
+
+        # Атомарно подменяем снимок данных
+        self._data = data
+        self.load_duration = time.perf_counter() - t_start
+
+        # Рекомендации, закэшированные на предыдущих данных, неактуальны
+        if self.recs_cache is not None:
+            self.recs_cache.clear()
+
+        self.logger.info(
+            f'Data version {data.version} loaded in '
+            f'{self.load_duration:.2f}s: personal recs for '
+            f'{len(data.personal_recs)} users, item factors for '
+            f'{len(data.item_factors)} items, similar items for '
+            f'{len(data.item_neighbours)} items'
+        )
+
+    def reload_data(self) -> bool:
+        """
+        Reload data unless another reload is already in progress (returns
+        False in that case). Requests are served with previous data until
+        the new data is loaded and validated.
+        """
+
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+
+        try:
+            self.load_data()
+        finally:
+            self._reload_lock.release()
+
+        return True
+
+    def _load_parquet(self, version: float) -> RecSysData:
+        """Load pre-calculated recommendations from .parquet files."""
 
         self.logger.info(
             f'Loading items_train from: {self.path_items_train}'
         )
 
         # Загружаем каталог товаров на котором считались рекомендации,
-        # преобразуем в словарь формата {item_id: category_id, ...}
-        self._item_cats = (
-            pd.read_parquet(self.path_items_train)
-            .set_index('item_id')
-            ['category_id']
-            .to_dict()
+        # преобразуем в отображение item_id -> category_id на массивах
+        item_cats = ItemCategoryMap.from_frame(
+            pd.read_parquet(
+                self.path_items_train,
+                columns=['item_id', 'category_id']
+            )
         )
 
         self.logger.info(
@@ -73,16 +361,14 @@ class RecSysHandler:
         )
 
         # Загружаем топ-популярные рекомендации в формате
-        # (item_id, score, category_id)
-        # NB: устанавливаем category_id как индекс, храним
-        # глобально отсортированным по убыванию score
-        self._top_popular = (
-            pd.read_parquet(
-                self.path_recs_top_popular,
-                columns=['item_id', 'score', 'category_id']
-            )
-            .sort_values(by='score', ascending=False)
-            .set_index('category_id')
+        # (item_id, score, category_id) и заранее раскладываем
+        # по категориям в массивы, отсортированные по убыванию score
+        top_popular_frame = pd.read_parquet(
+            self.path_recs_top_popular,
+            columns=['item_id', 'score', 'category_id']
+        )
+        top_popular = TopPopularStore.from_frame(
+            top_popular_frame, max_n=self.top_popular_max_n
         )
 
         self.logger.info(
@@ -90,67 +376,269 @@ class RecSysHandler:
         )
 
         # Загружаем персональные рекомендации в формате
-        # (user_id, item_id, score),
-        # NB: устанавливаем user_id как индекс, для каждого
-        # пользователя строки отсортрованы по убыванию score
-        self._personal_recs = (
+        # (user_id, item_id, score) и упаковываем в компактное
+        # хранилище на массивах numpy: для каждого пользователя
+        # рекомендации отсортированы по убыванию score
+        personal_recs = PersonalRecsStore.from_frame(
             pd.read_parquet(
                 self.path_recs_personal,
                 columns=['user_id', 'item_id', 'score']
             )
-            .sort_values(by=['user_id', 'score'], ascending=[True, False])
-            .set_index('user_id')
         )
 
-        # Формируем set() пользователей, имеющих персональные рекомендации
-        self._users_with_personal_recs = set(
-            self._personal_recs.index.drop_duplicates()
+        # Загружаем факторы товаров модели ALS (если заданы) в формате
+        # (item_id, factors), параметры модели - в атрибутах таблицы.
+        # Кандидаты для fold-in - самые популярные товары
+        if self._optional_exists(self.path_item_factors):
+            self.logger.info(
+                f'Loading ALS item factors from: {self.path_item_factors}'
+            )
+            item_factors_frame = pd.read_parquet(
+                self.path_item_factors, columns=['item_id', 'factors']
+            )
+            item_factors = ItemFactorsStore.from_frame(
+                item_factors_frame,
+                regularization=item_factors_frame.attrs['regularization'],
+                confidence=item_factors_frame.attrs['confidence'],
+                popular_items=top_popular_frame.sort_values(
+                    by='score', ascending=False, kind='stable'
+                )['item_id'].to_numpy(),
+                max_candidates=self.fold_in_max_candidates
+            )
+        else:
+            if self.path_item_factors:
+                self.logger.warning(
+                    f'ALS item factors not found at {self.path_item_factors}'
+                    ', online fold-in is disabled'
+                )
+            item_factors = ItemFactorsStore.empty()
+
+        # Загружаем похожие товары (если заданы) в формате
+        # (item_id, neighbour_id, score) и раскладываем в массив
+        # фиксированной ширины
+        if self._optional_exists(self.path_item_neighbours):
+            self.logger.info(
+                f'Loading similar items from: {self.path_item_neighbours}'
+            )
+            item_neighbours = ItemNeighboursStore.from_frame(
+                pd.read_parquet(
+                    self.path_item_neighbours,
+                    columns=['item_id', 'neighbour_id', 'score']
+                )
+            )
+        else:
+            if self.path_item_neighbours:
+                self.logger.warning(
+                    f'Similar items not found at {self.path_item_neighbours}'
+                    ', item-to-item recs are disabled'
+                )
+            item_neighbours = ItemNeighboursStore.empty()
+
+        return RecSysData(
+            item_cats, top_popular, personal_recs, item_factors,
+            item_neighbours, version
+        )
+
+    def _load_bundle(self, version: float) -> RecSysData:
+        """Memory-map pre-calculated recommendations from serving bundle."""
+
+        self.logger.info(
+            f'Loading serving bundle from: {self.path_recs_bundle}'
+        )
+
+        stores, meta = load_bundle(self.path_recs_bundle, mmap=True)
+
+        # Параметры, с которыми собран бандл, должны совпадать с настройками
+        # хендлера (иначе, например, допустимый n_recs расходится с длиной
+        # топ-популярных в бандле)
+        settings = {'top_popular_max_n': self.top_popular_max_n}
+        if self.path_item_factors:
+            settings['fold_in_max_candidates'] = self.fold_in_max_candidates
+        for name, value in settings.items():
+            if meta.get(name) != value:
+                raise ValueError(
+                    f'Bundle {name}={meta.get(name)} differs from handler '
+                    f'setting {name}={value} in {self.path_recs_bundle}'
+                )
+
+        return RecSysData(
+            item_cats=ItemCategoryMap(**stores['item_cats']),
+            top_popular=TopPopularStore(**stores['top_popular']),
+            personal_recs=PersonalRecsStore(**stores['personal']),
+            # NB: факторы и похожие товары в бандле необязательны и, как
+            # и при загрузке .parquet файлов, используются, только если
+            # заданы пути к ним (бандл пайплайна содержит их всегда)
+            item_factors=(
+                ItemFactorsStore(**stores['item_factors'])
+                if 'item_factors' in stores and self.path_item_factors
+                else ItemFactorsStore.empty()
+            ),
+            item_neighbours=(
+                ItemNeighboursStore(**stores['item_neighbours'])
+                if 'item_neighbours' in stores and self.path_item_neighbours
+                else ItemNeighboursStore.empty()
+            ),
+            version=version
+        )
+
+    def _validate(self, data: RecSysData):
+        """Check loaded data consistency, raise ValueError if broken."""
+
+        personal_recs = data.personal_recs
+        top_popular = data.top_popular
+
+        if not len(top_popular.global_items):
+            raise ValueError('No top-popular items loaded')
+
+        for name, indptr, values in (
+            ('personal', personal_recs.indptr, personal_recs.items),
+            ('top-popular', top_popular.category_indptr,
+             top_popular.category_items)
+        ):
+            if indptr[0] != 0 or indptr[-1] != len(values):
+                raise ValueError(f'Inconsistent {name} recs offsets')
+
+        if np.any(np.diff(personal_recs.user_ids) <= 0):
+            raise ValueError('Personal recs user ids are not sorted')
+
+        item_factors = data.item_factors
+        if len(item_factors):
+            if np.any(np.diff(item_factors.item_ids) <= 0):
+                raise ValueError('Item factors ids are not sorted')
+            if (
+                item_factors.factors.shape[0] != len(item_factors)
+                or item_factors.gram.shape != (
+                    item_factors.factors.shape[1],
+                    item_factors.factors.shape[1]
+                )
+                or item_factors.candidate_factors.shape != (
+                    len(item_factors.candidate_ids),
+                    item_factors.factors.shape[1]
+                )
+            ):
+                raise ValueError('Inconsistent item factors shapes')
+
+            # Пробный расчет рекомендаций для 'нового' пользователя
+            self._get_fold_in_recs(
+                data, 10, [item_factors.item_ids[:3].tolist()]
+            )
+
+        item_neighbours = data.item_neighbours
+        if np.any(np.diff(item_neighbours.item_ids) <= 0):
+            raise ValueError('Similar items ids are not sorted')
+        if item_neighbours.neighbours.shape[0] != len(item_neighbours):
+            raise ValueError('Inconsistent similar items shapes')
+
+        # Пробный расчет рекомендаций на новых данных
+        user_id = (
+            int(personal_recs.user_ids[0]) if len(personal_recs) else 0
+        )
+        self._get_recs(
+            data, user_id, 10, top_popular.global_items[:3].tolist()
+        )
+
+    def export_bundle(self, path: str):
+        """
+        Export loaded data to a serving bundle: a directory with fixed-width
+        arrays which can be memory-mapped by several processes at once.
+        """
+
+        save_bundle(
+            path,
+            stores={
+                'item_cats': self._data.item_cats,
+                'top_popular': self._data.top_popular,
+                'personal': self._data.personal_recs,
+                'item_factors': self._data.item_factors,
+                'item_neighbours': self._data.item_neighbours
+            },
+            meta={
+                'top_popular_max_n': self.top_popular_max_n,
+                'fold_in_max_candidates': self.fold_in_max_candidates
+            }
         )
 
+        self.logger.info(f'Serving bundle exported to: {path}')
+
+    def _get_fold_in_recs(
+            self,
+            data: RecSysData,
+            n_recs: int,
+            last_items: list[list[int]]
+    ) -> list[list[int]]:
+        """
+        Get personal recommendations for users without pre-calculated ones
+        by ALS fold-in of their last items (empty list for users with no
+        known items or if fold-in is disabled).
+        """
+
+        recs = [[] for _ in last_items]
+
+        if not len(data.item_factors):
+            return recs
+
+        # Факторы пользователей по последним товарам
+        folded = [
+            (i, data.item_factors.fold_in(as_id_array(items)))
+            for i, items in enumerate(last_items) if items
+        ]
+        folded = [(i, factors) for i, factors in folded if factors is not None]
+        if not folded:
+            return recs
+
+        # Скоры кандидатов (ограниченного числа популярных товаров)
+        # для каждого пользователя
+        top_items = data.item_factors.recommend(
+            np.stack([factors for _, factors in folded]), n_recs
+        )
+        for (i, _), items in zip(folded, top_items.tolist()):
+            recs[i] = items
+
+        return recs
+
     def _get_top_popular(
         self,
+        data: RecSysData,
         n_recs: int,
         category_id: int | None,
     ) -> list[int]:
         """Get top-popular by category or globaly if _category_id_ is None."""
 
-        if category_id is None:
-            # Топ-популярные по всем категориям
-            return self._top_popular['item_id'].head(n_recs).tolist()
+        return data.top_popular.get_items(n_recs, category_id).tolist()
 
-        return (
-            self._top_popular.loc[category_id, 'item_id'].head(n_recs).tolist()
-        )
+    def _get_last_categories(
+            self,
+            last_categories: list[int]
+    ) -> tuple[int, ...]:
+        """Drop unknown (missing) categories and duplicates keeping order."""
+
+        return tuple(dict.fromkeys(
+            category_id for category_id in last_categories
+            if category_id != ItemCategoryMap.MISSING
+        ))
 
     def _get_online_recs(
             self,
+            data: RecSysData,
             n_recs: int,
-            last_items: list[int]
+            last_categories: tuple[int, ...]
     ) -> list[int]:
-        """Get online recommendations based on last items seen online."""
+        """Get online recommendations based on last categories seen online."""
 
         # Топ-популярные по всем категорям
-        top_popular_items = self._get_top_popular(n_recs, category_id=None)
+        top_popular_items = self._get_top_popular(
+            data, n_recs, category_id=None
+        )
 
-        # Если нет последних просмотренных - отдаем глобальный топ
-        if not last_items:
+        # Если нет последних просмотренных категорий - отдаем глобальный топ
+        if not last_categories:
             return top_popular_items
 
-        # Получаем список трех последних просмотренных категорий в обратном
-        # порядке (начиная с последней просмотренной)
-        last_categories = [self._item_cats.get(item)
-                           for item in reversed(last_items[-3:])]
-
-        # Удаляем из списка последних категорий возможные дубликаты / пропуски
-        last_categories = (
-            pd.Series(last_categories).dropna().drop_duplicates().tolist()
-        )
-
         # Каждую категорию в списке преобразуем в список топ-популярных
         # товаров в этой категории. В конец полученномого списка (из списков)
         # добавляем глобальный топ.
         list_of_lists = (
-            [self._get_top_popular(n_recs, category_id)
+            [self._get_top_popular(data, n_recs, category_id)
              for category_id in last_categories]
             + [top_popular_items]
         )
@@ -159,36 +647,260 @@ class RecSysHandler:
         # путем чередования:
         # первый из первого списка, первый из второго списка, ...
         # второй из первого списка, второй из второго списка и т.д.
-        online_recs = [item for items_tuple in zip_longest(*list_of_lists)
-                       for item in items_tuple if item is not None]
+        # с удалением дубликатов и обрезкой до n_recs
+        return interleave_unique(list_of_lists, n_recs)
 
-        # Удаляем возможные дубликаты, обрезаем до n_recs и отдаем
-        return pd.Series(online_recs).drop_duplicates().head(n_recs).tolist()
+    def _get_similar_recs(
+            self,
+            data: RecSysData,
+            n_recs: int,
+            positions: list[int]
+    ) -> list[int]:
+        """
+        Get items similar to last items given positions of last items
+        (the latest first) in item neighbours store (-1 for unknown items).
+        """
+
+        # Объединяем соседей всех последних товаров путем чередования.
+        # NB: стоимость ограничена: не более трех товаров и не более
+        # n_recs соседей каждого
+        return interleave_unique(
+            [data.item_neighbours.get_items_at(pos, n_recs).tolist()
+             for pos in positions if pos >= 0],
+            n_recs
+        )
 
-    def get_recs(
+    def _blend_recs(
             self,
-            user_id: int,
             n_recs: int,
-            last_items: list[int]
+            online_recs: list[int],
+            similar_recs: list[int],
+            personal_recs: list[int]
     ) -> list[int]:
-        """Get list of recommendations."""
+        """Blend online, similar items and personal recommendations."""
+
+        # Если нет похожих и персональных - отдаем онлайн рекомендации
+        if not similar_recs and not personal_recs:
+            return online_recs
+
+        # Объединяем списки путем чередования онлайн, похожих
+        # и персональных, удаляем возможные дубликаты, обрезаем до n_recs
+        # и отдаем
+        return interleave_unique(
+            [online_recs, similar_recs, personal_recs], n_recs
+        )
+
+    def _get_recs(
+            self,
+            data: RecSysData,
+            user_id: int,
+            n_recs: int,
+            last_items: list[int],
+            timer: PhaseTimer | None = None
+    ) -> tuple[list[int], str]:
+        """
+        Get list of recommendations using given data snapshot and the source
+        of personal part of recommendations (personal | fold_in | online).
+        If timer is given, durations of handling phases are marked.
+        """
+
+        # Получаем список трех последних просмотренных категорий в обратном
+        # порядке (начиная с последней просмотренной)
+        last_categories = self._get_last_categories(
+            [data.item_cats.get(item) for item in reversed(last_items[-3:])]
+        )
+        if timer:
+            timer.mark('last_categories')
+
+        # Товары, похожие на три последних просмотренных
+        similar_recs = self._get_similar_recs(
+            data,
+            n_recs,
+            data.item_neighbours.find_many(
+                as_id_array(last_items[-3:][::-1])
+            ).tolist()
+        )
+        if timer:
+            timer.mark('similar')
 
         # Онлайн рекомендации есть всегда: если не было последних просмотров -
         # получим топ-популярные по всем категорям
-        online_recs = self._get_online_recs(n_recs, last_items)
-
-        # Если нет персональных - отдаем онлайн рекомендации
-        if user_id not in self._users_with_personal_recs:
-            return online_recs
+        online_recs = self._get_online_recs(data, n_recs, last_categories)
+        if timer:
+            timer.mark('online')
 
         # Персональные рекомендации (коллаборативыне оффлайн)
         personal_recs = (
-            self._personal_recs.loc[user_id, 'item_id'].head(n_recs).tolist()
+            data.personal_recs.get_items(user_id, n_recs).tolist()
         )
+        source = 'personal'
+        if timer:
+            timer.mark('personal')
+
+        # Для пользователей без оффлайн рекомендаций - ALS fold-in
+        # по трем последним товарам
+        if not personal_recs and last_items:
+            personal_recs = self._get_fold_in_recs(
+                data, n_recs, [last_items[-3:]]
+            )[0]
+            source = 'fold_in'
+            if timer:
+                timer.mark('fold_in')
+
+        # Без персональной части рекомендации только онлайн
+        if not personal_recs:
+            source = 'online'
+
+        recs = self._blend_recs(
+            n_recs, online_recs, similar_recs, personal_recs
+        )
+        if timer:
+            timer.mark('blend')
 
-        # Объединяем два списка путем чередования онлайн и персональных
-        final_recs = [x for pair in zip_longest(online_recs, personal_recs)
-                      for x in pair if x is not None]
+        return recs, source
 
-        # Удаляем возможные дубликаты, обрезаем до n_recs и отдаем
-        return pd.Series(final_recs).drop_duplicates().head(n_recs).tolist()
+    def get_recs(
+            self,
+            user_id: int,
+            n_recs: int,
+            last_items: list[int]
+    ) -> list[int]:
+        """Get list of recommendations."""
+
+        # NB: берем текущий снимок данных один раз на весь запрос
+        data = self._data
+
+        # Замеряем длительности этапов только для выборки запросов
+        timer = self.handler_metrics.start() if self.handler_metrics else None
+
+        if self.recs_cache is None:
+            recs, source = self._get_recs(
+                data, user_id, n_recs, last_items, timer
+            )
+        else:
+            # Рекомендации зависят только от трех последних просмотренных
+            # товаров, а для пользователей без персональных рекомендаций
+            # (новых и анонимных) - не зависят от user_id, поэтому такие
+            # пользователи делят записи кэша. Версия данных в ключе исключает
+            # попадание в кэш рекомендаций, рассчитанных на старом снимке
+            # во время перезагрузки
+            user_key = (
+                user_id if user_id in data.personal_recs else COLD_USER_KEY
+            )
+            key = (data.version, user_key, n_recs, tuple(last_items[-3:]))
+
+            recs = self.recs_cache.get(key)
+            source = 'cache'
+            if timer:
+                timer.mark('cache')
+            if recs is None:
+                recs, source = self._get_recs(
+                    data, user_id, n_recs, last_items, timer
+                )
+                self.recs_cache.put(key, recs)
+
+        if timer:
+            self.handler_metrics.observe(timer, 'single', source, n_recs)
+
+        return recs
+
+    def get_recs_batch(
+            self,
+            user_ids: list[int],
+            n_recs: list[int],
+            last_items: list[list[int]],
+            with_sources: bool = False
+    ) -> list[list[int]] | tuple[list[list[int]], list[str]]:
+        """
+        Get lists of recommendations for a batch of requests (and, if
+        with_sources is True, the source of personal part of recommendations
+        of each request: personal | fold_in | online).
+
+        Personal recs and last categories are looked up for the whole batch
+        at once, online recs are calculated once per each distinct pair
+        (n_recs, last categories) in the batch, fold-in recs are scored
+        at once for all requests with the same n_recs.
+        """
+
+        # NB: берем текущий снимок данных один раз на весь батч
+        data = self._data
+
+        # Замеряем длительности этапов только для выборки батчей
+        timer = self.handler_metrics.start() if self.handler_metrics else None
+
+        # Ищем персональные рекомендации сразу для всех пользователей
+        personal_pos = data.personal_recs.find_many(as_id_array(user_ids))
+
+        # Получаем категории трех последних просмотренных товаров
+        # (в обратном порядке) и их позиции в хранилище похожих товаров
+        # сразу для всех запросов
+        last_items = [items[-3:][::-1] for items in last_items]
+        all_last_items = as_id_array(
+            [item for items in last_items for item in items]
+        )
+        all_categories = data.item_cats.get_many(all_last_items).tolist()
+        all_neighbours_pos = (
+            data.item_neighbours.find_many(all_last_items).tolist()
+        )
+        if timer:
+            timer.mark('lookup')
+
+        # Для пользователей без оффлайн рекомендаций - ALS fold-in
+        # по трем последним товарам: сразу для всех запросов батча
+        # с одинаковым n_recs
+        fold_in_requests = {}
+        if len(data.item_factors):
+            for i, (n, items, pos) in enumerate(
+                zip(n_recs, last_items, personal_pos.tolist())
+            ):
+                if pos < 0 and items:
+                    fold_in_requests.setdefault(n, []).append(i)
+
+        fold_in_recs = {}
+        for n, indices in fold_in_requests.items():
+            fold_in_recs.update(zip(indices, self._get_fold_in_recs(
+                data, n, [last_items[i] for i in indices]
+            )))
+        if timer:
+            timer.mark('fold_in')
+
+        # Онлайн рекомендации, уже рассчитанные в рамках батча
+        online_recs_cache = {}
+
+        batch_recs = []
+        sources = []
+        offset = 0
+        for i, (n, items, pos) in enumerate(
+            zip(n_recs, last_items, personal_pos.tolist())
+        ):
+
+            last_categories = self._get_last_categories(
+                all_categories[offset:offset + len(items)]
+            )
+            similar_recs = self._get_similar_recs(
+                data, n, all_neighbours_pos[offset:offset + len(items)]
+            )
+            offset += len(items)
+
+            key = (n, last_categories)
+            if key not in online_recs_cache:
+                online_recs_cache[key] = self._get_online_recs(
+                    data, n, last_categories
+                )
+
+            if i in fold_in_recs:
+                personal_recs, source = fold_in_recs[i], 'fold_in'
+            else:
+                personal_recs = data.personal_recs.get_items_at(pos, n)
+                personal_recs, source = personal_recs.tolist(), 'personal'
+
+            batch_recs.append(self._blend_recs(
+                n, online_recs_cache[key], similar_recs, personal_recs
+            ))
+            sources.append(source if personal_recs else 'online')
+
+        if timer:
+            timer.mark('merge')
+            self.handler_metrics.observe(timer, 'batch')
+
+        return (batch_recs, sources) if with_sources else batch_recs
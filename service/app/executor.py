@@ -0,0 +1,95 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from prometheus_client import Gauge, Histogram
+
+
+class HandlerQueueFullError(Exception):
+    """Raised when a call is rejected because the executor queue is full."""
+
+
+class BoundedHandlerExecutor:
+    """
+    Bounded executor for CPU-bound handler calls with admission control.
+
+    Attributes:
+        - **max_workers** - number of worker threads running handler calls
+
+        - **max_queue** - max number of calls waiting for a free worker,
+        calls exceeding the limit are rejected with HandlerQueueFullError
+
+        - **metric_queue_depth** - gauge of number of calls waiting
+        for a free worker
+
+        - **metric_queue_wait** - histogram of time (sec) calls spent
+        waiting for a free worker
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_queue: int,
+        metric_queue_depth: Gauge,
+        metric_queue_wait: Histogram
+    ):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.metric_queue_depth = metric_queue_depth
+        self.metric_queue_wait = metric_queue_wait
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='recsys_handler'
+        )
+
+        # Число принятых, но еще не завершенных вызовов
+        # NB: изменяется только из потока event loop
+        self._in_flight = 0
+
+    async def run(self, func: Callable, /, *args, **kwargs) -> Any:
+        """Run func(*args, **kwargs) in a worker thread and await result."""
+
+        # Отклоняем вызов, если все воркеры заняты и очередь заполнена
+        if self._in_flight >= self.max_workers + self.max_queue:
+            raise HandlerQueueFullError(
+                f'Handler queue is full ({self.max_queue} calls waiting)'
+            )
+
+        self._in_flight += 1
+        self.metric_queue_depth.inc()
+        submitted = time.perf_counter()
+
+        # Вызов покидает очередь либо при старте в воркере, либо при отмене
+        # до старта: кто первым заберет 'жетон', тот и уменьшает счетчик
+        # (list.pop() атомарен)
+        in_queue_token = [True]
+
+        def leave_queue() -> bool:
+            try:
+                in_queue_token.pop()
+            except IndexError:
+                return False
+            self.metric_queue_depth.dec()
+            return True
+
+        def call():
+            if leave_queue():
+                self.metric_queue_wait.observe(
+                    time.perf_counter() - submitted
+                )
+            return func(*args, **kwargs)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, call
+            )
+        finally:
+            leave_queue()
+            self._in_flight -= 1
+
+    def shutdown(self):
+        """Shutdown worker threads, cancelling calls not started yet."""
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
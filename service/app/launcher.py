@@ -0,0 +1,136 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import uvicorn
+from core import RecSysHandler
+from dotenv import load_dotenv
+from reloader import ArtifactWatcher
+
+load_dotenv('.env_service')
+
+logger = logging.getLogger('recsys_launcher')
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(
+    logging.Formatter(
+        '%(levelname)s:\t%(name)s:  %(asctime)s : %(message)s'
+    )
+)
+logger.addHandler(log_handler)
+logger.setLevel(os.getenv('APP_LOG_LEVEL'))
+
+
+def get_parquet_handler() -> RecSysHandler:
+    """
+    Get handler loading data from .parquet files (settings - the same as of
+    service workers, which check them against the bundle).
+    """
+
+    return RecSysHandler.from_env(path_recs_bundle=None)
+
+
+def export_bundle(path_recs_bundle: str) -> bool:
+    """
+    Load .parquet files and export them to a serving bundle
+    (returns True once exported, e.g. for `ArtifactWatcher`).
+    """
+
+    # NB: хендлер (и данные) удаляются после выхода из функции,
+    # процесс-лаунчер не держит в памяти копию данных
+    handler = get_parquet_handler()
+    handler.load_data()
+    handler.export_bundle(path_recs_bundle)
+
+    return True
+
+
+def prepare_bundle() -> tuple[str, bool]:
+    """
+    Return path to a serving bundle to be attached by workers and a flag
+    whether the bundle is built by the launcher.
+
+    If PATH_RECS_BUNDLE points to an existing bundle it is used as is,
+    otherwise .parquet files are loaded once and exported to a bundle
+    at BUNDLE_CACHE_DIR.
+    """
+
+    path_recs_bundle = os.getenv('PATH_RECS_BUNDLE')
+    if path_recs_bundle and Path(path_recs_bundle).exists():
+        logger.info(f'Using existing serving bundle: {path_recs_bundle}')
+        return path_recs_bundle, False
+
+    path_recs_bundle = os.getenv('BUNDLE_CACHE_DIR', 'bundle')
+    export_bundle(path_recs_bundle)
+
+    return path_recs_bundle, True
+
+
+def prepare_prometheus_multiproc_dir() -> str:
+    """Create empty directory for prometheus multiprocess metrics."""
+
+    multiproc_dir = Path(
+        os.getenv('PROMETHEUS_MULTIPROC_DIR', 'prometheus_multiproc')
+    )
+
+    # Метрики предыдущего запуска должны быть удалены
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    multiproc_dir.mkdir(parents=True)
+
+    return str(multiproc_dir)
+
+
+def main():
+    """
+    Production launcher: prepare data once and start several uvicorn
+    workers, each memory-mapping the same read-only serving bundle.
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--host', default=os.getenv('SERVICE_HOST'))
+    parser.add_argument('--port', type=int,
+                        default=int(os.getenv('APP_PORT_EXTERNAL')))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('APP_WORKERS', 1)))
+    args = parser.parse_args()
+
+    path_recs_bundle, bundle_is_built = prepare_bundle()
+
+    # NB: переменные окружения наследуются процессами-воркерами
+    os.environ['PATH_RECS_BUNDLE'] = path_recs_bundle
+
+    # Метрики нескольких воркеров агрегируются через файлы (multiprocess
+    # mode). NB: prometheus_client уже импортирован лаунчером (через core)
+    # без PROMETHEUS_MULTIPROC_DIR, поэтому с одним воркером, работающим в
+    # процессе лаунчера, этот режим не включается - метрики хранятся
+    # в памяти процесса, как при обычном запуске uvicorn
+    if args.workers > 1 or 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = (
+            prepare_prometheus_multiproc_dir()
+        )
+
+    # При изменении .parquet файлов пересобираем бандл, воркеры
+    # перезагрузят его, обнаружив изменение бандла
+    reload_watch_interval = float(os.getenv('RELOAD_WATCH_INTERVAL', 0))
+    if bundle_is_built and reload_watch_interval > 0:
+        ArtifactWatcher(
+            get_paths=get_parquet_handler().artifact_paths,
+            on_change=lambda: export_bundle(path_recs_bundle),
+            interval=reload_watch_interval
+        ).start()
+
+    logger.info(f'Starting {args.workers} service worker(s)')
+
+    uvicorn.run(
+        'service:app',
+        app_dir=str(Path(__file__).parent),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of all threads of the current process.
+
+    While profiling, stacks of all threads are sampled every `interval`
+    seconds (via `sys._current_frames`), so profiled code is not
+    instrumented and runs at full speed; nothing runs between profiles.
+    Result is returned in the collapsed stack format accepted by
+    flamegraph tools (flamegraph.pl, speedscope, inferno): one line per
+    distinct stack `thread;frame;...;frame count`, root frame first.
+
+    Attributes:
+        - **max_duration** - max duration (sec) of a single profile
+
+        - **min_interval** - min interval (sec) between samples
+    """
+
+    def __init__(self, max_duration: float, min_interval: float = 0.001):
+        self.max_duration = max_duration
+        self.min_interval = min_interval
+
+        # Одновременно выполняется только один профиль
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _collapse(frame) -> tuple[str, ...]:
+        """Get stack of the frame as tuple of frame names, root first."""
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f'{code.co_name} '
+                f'({code.co_filename.rsplit("/", 1)[-1]}:'
+                f'{code.co_firstlineno})'
+            )
+            frame = frame.f_back
+
+        return tuple(reversed(stack))
+
+    def profile(self, duration: float, interval: float) -> tuple[str, int]:
+        """
+        Sample stacks of all threads (except the profiler's own one)
+        for `duration` seconds. Returns collapsed stacks and the number
+        of samples taken.
+        """
+
+        duration = min(duration, self.max_duration)
+        # NB: интервал больше длительности не должен продлевать профиль
+        interval = min(max(interval, self.min_interval), duration)
+
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError('Profiling is already in progress')
+
+        try:
+            own_id = threading.get_ident()
+            stacks = Counter()
+            n_samples = 0
+
+            deadline = time.perf_counter() + duration
+            while time.perf_counter() < deadline:
+                thread_names = {
+                    thread.ident: thread.name
+                    for thread in threading.enumerate()
+                }
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stacks[(
+                        thread_names.get(thread_id, str(thread_id)),
+                        *self._collapse(frame)
+                    )] += 1
+                n_samples += 1
+                time.sleep(interval)
+
+        finally:
+            self._lock.release()
+
+        collapsed = '\n'.join(
+            f'{";".join(stack)} {count}'
+            for stack, count in stacks.most_common()
+        )
+
+        return collapsed, n_samples
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+from typing import Callable
+
+
+class ArtifactWatcher:
+    """
+    Background watcher calling `on_change` when artifact files change.
+
+    Modification times of files are polled every `interval` seconds,
+    `on_change` is called once files stop changing (i.e. two consecutive
+    polls return the same state, which differs from the last handled one).
+    If the change is not applied (`on_change` returns False or raises),
+    it is retried on the next poll.
+
+    Attributes:
+        - **get_paths** - callable returning list of watched file paths
+
+        - **on_change** - callable to run when watched files change,
+        returns whether the change is applied (e.g. False if another
+        reload is in progress)
+
+        - **interval** - polling interval in seconds
+    """
+
+    def __init__(
+        self,
+        get_paths: Callable[[], list[str]],
+        on_change: Callable[[], bool],
+        interval: float
+    ):
+        self.get_paths = get_paths
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = logging.getLogger('recsys_service')
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='artifact_watcher', daemon=True
+        )
+
+    def _get_state(self) -> tuple:
+        """Get (path, mtime, size) of watched files (None if missing)."""
+
+        state = []
+        for path in self.get_paths():
+            try:
+                stat = os.stat(path)
+                state.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                state.append((path, None, None))
+
+        return tuple(state)
+
+    def _run(self):
+        handled_state = previous_state = self._get_state()
+
+        while not self._stop_event.wait(self.interval):
+            state = self._get_state()
+
+            # Ждем, пока файлы перестанут изменяться (запись завершена)
+            if state != handled_state and state == previous_state:
+                self.logger.info('Artifacts change detected')
+                try:
+                    applied = self.on_change()
+                except Exception as exc:
+                    self.logger.error(
+                        f'Failed to handle artifacts change: {exc}',
+                        exc_info=True
+                    )
+                    applied = False
+
+                # Непримененное изменение (ошибка или параллельная
+                # перезагрузка) повторяем при следующей проверке
+                if applied:
+                    handled_state = state
+                else:
+                    self.logger.warning(
+                        'Artifacts change is not applied, will retry'
+                    )
+
+            previous_state = state
+
+    def start(self):
+        """Start watching in a background thread."""
+
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching."""
+
+        self._stop_event.set()
+        self._thread.join()
@@ -1,14 +1,23 @@
 import logging
+import math
 import os
+import secrets
 import sys
 from contextlib import asynccontextmanager
 
 import requests
+from cache import RecsCache
 from core import RecSysHandler, RecSysRequest, RecSysResponse
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from prometheus_client import Counter
+from executor import BoundedHandlerExecutor, HandlerQueueFullError
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+from prometheus_client import Counter, Gauge, Histogram, multiprocess
+from profiler import ProfilerBusyError, SamplingProfiler
 from prometheus_fastapi_instrumentator import Instrumentator
+from reloader import ArtifactWatcher
+from timing import HandlerMetrics
 
 load_dotenv('.env_service')
 
@@ -24,20 +33,228 @@ logger.addHandler(log_handler)
 logger.setLevel(os.getenv('APP_LOG_LEVEL'))
 logger.info('Recsys service module is being initialized.')
 
+# Размер (0 - кэш отключен) и время жизни записей (сек) кэша рекомендаций
+RECS_CACHE_SIZE = int(os.getenv('RECS_CACHE_SIZE', 0))
+RECS_CACHE_TTL = float(os.getenv('RECS_CACHE_TTL', 60))
+
+# Метрика: счетчик попаданий в кэш рекомендаций
+metric_recs_cache_hits = Counter(
+    'app_recsys_cache_hits_counter',
+    'Number of recommendations cache hits'
+)
+
+# Метрика: счетчик промахов кэша рекомендаций
+metric_recs_cache_misses = Counter(
+    'app_recsys_cache_misses_counter',
+    'Number of recommendations cache misses'
+)
+
+# Метрика: счетчик вытесненных из кэша записей (reason: size | ttl | clear)
+metric_recs_cache_evictions = Counter(
+    'app_recsys_cache_evictions_counter',
+    'Number of entries evicted from recommendations cache',
+    ['reason']
+)
+
+# Кэш рекомендаций для повторяющихся запросов (если задан размер)
+recs_cache = RecsCache(
+    max_size=RECS_CACHE_SIZE,
+    ttl=RECS_CACHE_TTL,
+    metric_hits=metric_recs_cache_hits,
+    metric_misses=metric_recs_cache_misses,
+    metric_evictions=metric_recs_cache_evictions
+) if RECS_CACHE_SIZE > 0 else None
+
+# Доля вызовов хендлера, для которых замеряется длительность этапов
+# расчета рекомендаций, 0 - замеры отключены
+HANDLER_METRICS_SAMPLE_RATE = float(
+    os.getenv('HANDLER_METRICS_SAMPLE_RATE', 0)
+)
+
+# Границы корзин гистограмм длительности этапов (сек): этапы расчета
+# рекомендаций занимают от единиц микросекунд до миллисекунд
+HANDLER_METRICS_BUCKETS = (
+    .00001, .000025, .00005, .0001, .00025, .0005,
+    .001, .0025, .005, .01, .025, .05, .1, .25
+)
+
+# Метрика: длительность этапов вызова хендлера
+# (method: single | batch, phase: этап расчета)
+metric_handler_phase_duration = Histogram(
+    'app_recsys_handler_phase_seconds',
+    'Duration of recsys_handler call phases (sampled calls)',
+    ['method', 'phase'],
+    buckets=HANDLER_METRICS_BUCKETS
+)
+
+# Метрика: длительность расчета рекомендаций для одного запроса
+# (source: personal | fold_in | online | cache, n_recs_bucket: <=10, ...)
+metric_handler_recs_duration = Histogram(
+    'app_recsys_handler_recs_seconds',
+    'Duration of recsys_handler.get_recs calls (sampled calls)',
+    ['source', 'n_recs_bucket'],
+    buckets=HANDLER_METRICS_BUCKETS
+)
+
+# Замеры длительности этапов хендлера (если задана доля замеряемых вызовов)
+handler_metrics = HandlerMetrics(
+    sample_rate=HANDLER_METRICS_SAMPLE_RATE,
+    metric_phase_duration=metric_handler_phase_duration,
+    metric_recs_duration=metric_handler_recs_duration
+) if HANDLER_METRICS_SAMPLE_RATE > 0 else None
+
 # Основной объект-хендлер для получения рекомендаций
-recsys_handler = RecSysHandler(
-    path_recs_top_popular=os.getenv('PATH_RECS_TOP_POPULAR'),
-    path_recs_personal=os.getenv('PATH_RECS_PERSONAL'),
-    path_items_train=os.getenv('PATH_ITEMS_TRAIN'),
+recsys_handler = RecSysHandler.from_env(
+    recs_cache=recs_cache,
+    handler_metrics=handler_metrics
+)
+
+# Максимальное число запросов в одном батче
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 1000))
+
+# Асинхронный режим: вызовы хендлера выполняются в отдельном ограниченном
+# пуле потоков с ограниченной очередью, при переполнении которой
+# запросы отклоняются с кодом 503
+ASYNC_MODE = os.getenv('ASYNC_MODE', 'False').lower() in ('true', '1')
+
+# Метрика: кол-во вызовов хендлера, ожидающих свободного воркера
+metric_handler_queue_depth = Gauge(
+    'app_recsys_handler_queue_depth',
+    'Number of recsys_handler calls waiting for a free worker',
+    multiprocess_mode='livesum'
+)
+
+# Метрика: время ожидания вызова хендлера в очереди
+metric_handler_queue_wait = Histogram(
+    'app_recsys_handler_queue_wait_seconds',
+    'Time recsys_handler calls spent waiting for a free worker',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+
+# Метрика: счетчик запросов, отклоненных из-за переполнения очереди
+metric_handler_rejected_counter = Counter(
+    'app_recsys_handler_rejected_counter',
+    'Number of requests rejected due to full recsys_handler queue'
+)
+
+# Пул для вызовов хендлера (только в асинхронном режиме)
+handler_executor = BoundedHandlerExecutor(
+    max_workers=int(os.getenv('HANDLER_MAX_WORKERS', 4)),
+    max_queue=int(os.getenv('HANDLER_MAX_QUEUE', 256)),
+    metric_queue_depth=metric_handler_queue_depth,
+    metric_queue_wait=metric_handler_queue_wait
+) if ASYNC_MODE else None
+
+
+# Интервал (сек) проверки изменения файлов с рекомендациями для горячей
+# перезагрузки данных, 0 - проверка отключена
+RELOAD_WATCH_INTERVAL = float(os.getenv('RELOAD_WATCH_INTERVAL', 0))
+
+# Токен доступа к служебным (admin) эндпойнтам, если не задан -
+# служебные эндпойнты отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Служебный эндпойнт статистического профилирования процесса {True | False}
+# и максимальная длительность (сек) одного профиля
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'False').lower() in (
+    'true', '1'
+)
+PROFILER_MAX_DURATION = float(os.getenv('PROFILER_MAX_DURATION', 30))
+
+# Профилировщик (только если эндпойнт профилирования включен)
+profiler = SamplingProfiler(
+    max_duration=PROFILER_MAX_DURATION
+) if PROFILER_ENABLED else None
+
+# Метрика: версия загруженных данных (время изменения файлов рекомендаций)
+metric_data_version = Gauge(
+    'app_recsys_data_version_timestamp_seconds',
+    'Modification time of loaded recommendations artifacts',
+    multiprocess_mode='liveall'
+)
+
+# Метрика: длительность последней загрузки данных
+metric_data_load_duration = Gauge(
+    'app_recsys_data_load_duration_seconds',
+    'Duration of the latest recommendations data load',
+    multiprocess_mode='liveall'
+)
+
+# Метрика: счетчик перезагрузок данных (status: success | failed)
+metric_data_reload_counter = Counter(
+    'app_recsys_data_reload_counter',
+    'Number of recommendations data reloads',
+    ['status']
 )
 
 
+def update_data_metrics():
+    """Update loaded data version and load duration metrics."""
+
+    metric_data_version.set(recsys_handler.data_version)
+    metric_data_load_duration.set(recsys_handler.load_duration)
+
+
+def reload_recsys_data() -> bool:
+    """
+    Reload handler data (blocking call, to be run in a background thread).
+    Returns False if another reload is already in progress.
+    """
+
+    try:
+        reloaded = recsys_handler.reload_data()
+    except Exception:
+        metric_data_reload_counter.labels(status='failed').inc()
+        raise
+
+    if reloaded:
+        metric_data_reload_counter.labels(status='success').inc()
+        update_data_metrics()
+
+    return reloaded
+
+
+# Наблюдатель за файлами с рекомендациями (при заданном интервале)
+artifact_watcher = ArtifactWatcher(
+    get_paths=recsys_handler.artifact_paths,
+    on_change=reload_recsys_data,
+    interval=RELOAD_WATCH_INTERVAL
+) if RELOAD_WATCH_INTERVAL > 0 else None
+
+
+async def run_handler(func, **kwargs):
+    """
+    Run handler method in a bounded executor (async mode) or
+    in the default anyio threadpool.
+    """
+
+    if handler_executor is None:
+        return await run_in_threadpool(func, **kwargs)
+
+    return await handler_executor.run(func, **kwargs)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     recsys_handler.load_data()
+    update_data_metrics()
     logger.info('RecSysHandler data loaded, ready to serve requests.')
+    if artifact_watcher is not None:
+        artifact_watcher.start()
+    if handler_executor is not None:
+        logger.info(
+            f'Async mode: {handler_executor.max_workers} handler workers, '
+            f'max queue {handler_executor.max_queue}'
+        )
     yield
     logger.info('Recsys service is being shut down.')
+    if artifact_watcher is not None:
+        artifact_watcher.stop()
+    if handler_executor is not None:
+        handler_executor.shutdown()
+    # В режиме нескольких воркеров удаляем 'живые' метрики процесса
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
 
 
 # Основной объект приложения
@@ -53,6 +270,63 @@ metric_recommend_exception_counter = Counter(
 )
 
 
+def raise_service_unavailable(exc: HandlerQueueFullError):
+    """Shed load: count rejected request and respond with 503."""
+
+    metric_handler_rejected_counter.inc()
+    logger.warning(f'Request rejected: {exc}')
+
+    raise HTTPException(
+        status_code=requests.codes['service_unavailable'],
+        detail='Service is overloaded, please retry later',
+        headers={'Retry-After': '1'}
+    )
+
+
+def check_admin_token(x_admin_token: str | None = Header(None)):
+    """Allow access to admin endpoints only with a valid X-Admin-Token."""
+
+    if not ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=requests.codes['forbidden'],
+            detail='Admin endpoints are disabled'
+        )
+
+    if not secrets.compare_digest(x_admin_token or '', ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=requests.codes['unauthorized'],
+            detail='Invalid admin token'
+        )
+
+
+def check_profiler_enabled():
+    """Allow access to the profiling endpoint only if it is enabled."""
+
+    if profiler is None:
+        raise HTTPException(
+            status_code=requests.codes['not_found'],
+            detail='Profiler is disabled'
+        )
+
+
+def check_n_recs(n_recs: int, request_index: int | None = None):
+    """
+    Reject requests for more recommendations than top-popular items kept
+    per category (online recommendations can not be longer).
+    """
+
+    if n_recs > recsys_handler.top_popular_max_n:
+        request = (
+            f' of request {request_index}' if request_index is not None
+            else ''
+        )
+        raise HTTPException(
+            status_code=requests.codes['unprocessable_entity'],
+            detail=f'n_recs{request} exceeds maximum of '
+            f'{recsys_handler.top_popular_max_n}'
+        )
+
+
 # Healthcheck URI
 @app.get('/')
 def healthcheck():
@@ -64,23 +338,36 @@ def healthcheck():
 
 # Основной URI сервиса
 @app.post('/recs', response_model=RecSysResponse)
-def recommend(request: RecSysRequest):
+async def recommend(request: RecSysRequest):
     """Get recommendations."""
 
     logger.debug(f'Valid request received: {request}')
 
+    check_n_recs(request.n_recs)
+
     try:
         #  Передаем паремтры в хендлер и получаем рекомендации
-        response = RecSysResponse(recs=recsys_handler.get_recs(
+        recs = await run_handler(
+            recsys_handler.get_recs,
             user_id=request.user_id,
             n_recs=request.n_recs,
             last_items=request.last_items
-         ))
+        )
+
+        # Формирование ответа замеряем для выборки запросов
+        timer = handler_metrics.start() if handler_metrics else None
+        response = RecSysResponse(recs=recs)
+        if timer:
+            timer.mark('serialize')
+            handler_metrics.observe(timer, 'single')
 
         logger.debug(f'Sending back response: {response}')
 
         return response
 
+    except HandlerQueueFullError as exc:
+        raise_service_unavailable(exc)
+
     except Exception as exc:
 
         # Увеличиваем счетчик исключений
@@ -97,6 +384,138 @@ def recommend(request: RecSysRequest):
         )
 
 
+# URI для пакетного получения рекомендаций
+@app.post('/recs/batch', response_model=list[RecSysResponse])
+async def recommend_batch(requests_batch: list[RecSysRequest]):
+    """Get recommendations for a batch of requests."""
+
+    logger.debug(f'Valid batch of {len(requests_batch)} requests received')
+
+    if len(requests_batch) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=requests.codes['request_entity_too_large'],
+            detail=f'Batch size exceeds maximum of {MAX_BATCH_SIZE}'
+        )
+
+    for i, request in enumerate(requests_batch):
+        check_n_recs(request.n_recs, request_index=i)
+
+    try:
+        #  Передаем паремтры всех запросов в хендлер и получаем рекомендации
+        batch_recs = await run_handler(
+            recsys_handler.get_recs_batch,
+            user_ids=[request.user_id for request in requests_batch],
+            n_recs=[request.n_recs for request in requests_batch],
+            last_items=[request.last_items for request in requests_batch]
+        )
+
+        # Формирование ответа замеряем для выборки запросов
+        timer = handler_metrics.start() if handler_metrics else None
+        response = [RecSysResponse(recs=recs) for recs in batch_recs]
+        if timer:
+            timer.mark('serialize')
+            handler_metrics.observe(timer, 'batch')
+
+        return response
+
+    except HandlerQueueFullError as exc:
+        raise_service_unavailable(exc)
+
+    except Exception as exc:
+
+        # Увеличиваем счетчик исключений
+        metric_recommend_exception_counter.inc()
+
+        logger.error(
+            f'Unhandled exception in recsys_handler.get_recs_batch(): {exc}',
+            exc_info=True
+        )
+
+        raise HTTPException(
+            status_code=requests.codes['/o\\'],
+            detail='Internal server error'
+        )
+
+
+# URI для горячей перезагрузки данных
+@app.post('/admin/reload', dependencies=[Depends(check_admin_token)])
+async def reload_data():
+    """
+    Reload recommendations data without downtime: requests are served with
+    previous data until new data is loaded and validated.
+    """
+
+    logger.info('Data reload requested')
+
+    try:
+        reloaded = await run_in_threadpool(reload_recsys_data)
+
+    except Exception as exc:
+        logger.error(f'Data reload failed: {exc}', exc_info=True)
+
+        raise HTTPException(
+            status_code=requests.codes['/o\\'],
+            detail=f'Data reload failed, previous data is kept: {exc}'
+        )
+
+    if not reloaded:
+        raise HTTPException(
+            status_code=requests.codes['conflict'],
+            detail='Data reload is already in progress'
+        )
+
+    return {
+        'version': recsys_handler.data_version,
+        'load_duration': recsys_handler.load_duration
+    }
+
+
+# URI для статистического профилирования процесса сервиса
+@app.get(
+    '/admin/profile',
+    response_class=PlainTextResponse,
+    dependencies=[Depends(check_admin_token), Depends(check_profiler_enabled)]
+)
+async def profile(duration: float = 10, interval: float = 0.005):
+    """
+    Profile the serving process: stacks of all its threads are sampled every
+    `interval` seconds for `duration` seconds (at most PROFILER_MAX_DURATION).
+    Returns stacks in the collapsed format for flamegraph tools.
+    """
+
+    # NB: nan не проходит ни одно сравнение, поэтому проверяем конечность
+    if not all(
+        math.isfinite(value) and value > 0 for value in (duration, interval)
+    ):
+        raise HTTPException(
+            status_code=requests.codes['unprocessable'],
+            detail='Duration and interval must be positive finite numbers'
+        )
+
+    logger.info(f'Profiling requested: {duration} sec, interval {interval}')
+
+    try:
+        collapsed, n_samples = await run_in_threadpool(
+            profiler.profile, duration, interval
+        )
+
+    except ProfilerBusyError as exc:
+        raise HTTPException(
+            status_code=requests.codes['conflict'],
+            detail=str(exc)
+        )
+
+    # NB: в многопроцессном режиме профилируется только воркер,
+    # обработавший запрос (его pid - в заголовке ответа)
+    return PlainTextResponse(
+        collapsed,
+        headers={
+            'X-Profile-Samples': str(n_samples),
+            'X-Profile-Pid': str(os.getpid())
+        }
+    )
+
+
 logger.info('Recsys service module initialization completed.')
 
 if __name__ == "__main__":
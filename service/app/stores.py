@@ -0,0 +1,536 @@
+import numpy as np
+import pandas as pd
+
+# Идентификаторы больше этого значения заведомо отсутствуют в хранилищах
+_MAX_ID = np.iinfo('int64').max
+
+
+def as_id_array(ids: list[int]) -> np.ndarray:
+    """Convert list of non-negative ids to int64 array (clipping huge ids)."""
+
+    return np.fromiter((min(id_, _MAX_ID) for id_ in ids),
+                       dtype='int64', count=len(ids))
+
+
+def find_sorted(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """
+    Return positions of ids in a sorted array of unique ids
+    (-1 for not found).
+    """
+
+    if not len(sorted_ids):
+        return np.full(len(ids), -1)
+
+    pos = np.searchsorted(sorted_ids, ids)
+    pos[pos == len(sorted_ids)] = 0
+
+    return np.where(sorted_ids[pos] == ids, pos, -1)
+
+
+class ItemCategoryMap:
+    """
+    Item to category mapping stored as a dense array indexed by item id
+    (item ids are compact non-negative integers).
+
+    Attributes:
+        - **category_ids** - array of categories: `category_ids[item_id]`
+        is a category of item_id or MISSING if item is unknown
+    """
+
+    # Значение категории для неизвестных товаров
+    MISSING = -1
+
+    def __init__(self, category_ids: np.ndarray):
+        self.category_ids = category_ids
+
+    @classmethod
+    def from_frame(cls, items: pd.DataFrame) -> 'ItemCategoryMap':
+        """Build map from a table with columns (item_id, category_id)."""
+
+        item_ids = items['item_id'].to_numpy(dtype='int64')
+        category_ids = np.full(
+            item_ids.max() + 1 if len(item_ids) else 0,
+            cls.MISSING,
+            dtype='int32'
+        )
+        # NB: при повторах item_id остается последнее значение
+        category_ids[item_ids] = items['category_id'].to_numpy(dtype='int32')
+
+        return cls(category_ids)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Get arrays the map is built of (see `__init__`)."""
+
+        return {'category_ids': self.category_ids}
+
+    def get(self, item_id: int) -> int:
+        """Get category of item (MISSING for unknown item)."""
+
+        if item_id < len(self.category_ids):
+            return int(self.category_ids[item_id])
+        return self.MISSING
+
+    def get_many(self, item_ids: np.ndarray) -> np.ndarray:
+        """Get categories of items (MISSING for unknown items)."""
+
+        if not len(self.category_ids):
+            return np.full(len(item_ids), self.MISSING)
+
+        known = item_ids < len(self.category_ids)
+
+        return np.where(
+            known,
+            self.category_ids[np.where(known, item_ids, 0)],
+            self.MISSING
+        )
+
+
+class PersonalRecsStore:
+    """
+    Compact array-backed (CSR-like) storage of personal recommendations.
+
+    Attributes:
+        - **user_ids** - sorted array of ids of users with personal recs
+
+        - **indptr** - offsets array of length `len(user_ids) + 1`:
+        recommendations of `user_ids[i]` are stored at positions
+        `indptr[i]:indptr[i + 1]` of the flat arrays below
+
+        - **items** - flat int32 array of recommended item ids, for each
+        user sorted by descending score
+
+        - **scores** - flat float32 array of corresponding scores
+    """
+
+    def __init__(
+        self,
+        user_ids: np.ndarray,
+        indptr: np.ndarray,
+        items: np.ndarray,
+        scores: np.ndarray
+    ):
+        self.user_ids = user_ids
+        self.indptr = indptr
+        self.items = items
+        self.scores = scores
+
+    @classmethod
+    def from_frame(cls, recs: pd.DataFrame) -> 'PersonalRecsStore':
+        """Build store from a table with columns (user_id, item_id, score)."""
+
+        user_ids = recs['user_id'].to_numpy(dtype='int64')
+        scores = recs['score'].to_numpy(dtype='float32')
+
+        # Сортируем по user_id, внутри пользователя - по убыванию score
+        # NB: np.lexsort сортирует по последнему ключу в первую очередь
+        order = np.lexsort((-scores, user_ids))
+        user_ids = user_ids[order]
+
+        # Границы блоков рекомендаций каждого пользователя
+        unique_user_ids, counts = np.unique(user_ids, return_counts=True)
+        indptr = np.zeros(len(unique_user_ids) + 1, dtype='int64')
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(
+            user_ids=unique_user_ids,
+            indptr=indptr,
+            items=recs['item_id'].to_numpy(dtype='int32')[order],
+            scores=scores[order]
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Get arrays the store is built of (see `__init__`)."""
+
+        return {
+            'user_ids': self.user_ids,
+            'indptr': self.indptr,
+            'items': self.items,
+            'scores': self.scores
+        }
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._find(user_id) >= 0
+
+    def _find(self, user_id: int) -> int:
+        """Return position of user_id in `user_ids` or -1 if not found."""
+
+        pos = int(np.searchsorted(self.user_ids, user_id))
+        if pos < len(self.user_ids) and self.user_ids[pos] == user_id:
+            return pos
+        return -1
+
+    def find_many(self, user_ids: np.ndarray) -> np.ndarray:
+        """Return positions of users in `user_ids` (-1 for not found)."""
+
+        return find_sorted(self.user_ids, user_ids)
+
+    def get_items_at(self, pos: int, n_recs: int) -> np.ndarray:
+        """Get top n_recs items for user at position pos (-1 for none)."""
+
+        if pos < 0:
+            return self.items[:0]
+
+        start = self.indptr[pos]
+        return self.items[start:min(start + n_recs, self.indptr[pos + 1])]
+
+    def get_items(self, user_id: int, n_recs: int) -> np.ndarray:
+        """Get top n_recs items for user (empty array if there are none)."""
+
+        return self.get_items_at(self._find(user_id), n_recs)
+
+
+class ItemFactorsStore:
+    """
+    ALS item factors for online fold-in of users without pre-calculated
+    personal recommendations: a user vector is found from items the user
+    interacted with by solving the same least squares problem ALS solves
+    for users during training, items are scored by dot product.
+
+    Only a bounded pool of candidates (the most popular items having
+    factors) is scored, so the cost of a request does not grow with
+    the catalog size.
+
+    Attributes:
+        - **item_ids** - sorted int32 array of items having factors
+
+        - **factors** - float32 array of shape (len(item_ids), n_factors):
+        `factors[i]` are factors of `item_ids[i]`
+
+        - **gram** - float32 array of shape (n_factors, n_factors):
+        YᵀY + regularization·I, the part of the fold-in system common for
+        all users (Y - item factors)
+
+        - **confidence** - 0-d float32 array: confidence (weight in the
+        training matrix) of an interaction with an item
+
+        - **candidate_ids** - int32 array of items scored by `recommend`
+        sorted by descending popularity
+
+        - **candidate_factors** - float32 array of shape
+        (len(candidate_ids), n_factors): factors of candidates (a contiguous
+        copy, scoring does not gather rows of `factors`)
+    """
+
+    def __init__(
+        self,
+        item_ids: np.ndarray,
+        factors: np.ndarray,
+        gram: np.ndarray,
+        confidence: np.ndarray,
+        candidate_ids: np.ndarray,
+        candidate_factors: np.ndarray
+    ):
+        self.item_ids = item_ids
+        self.factors = factors
+        self.gram = gram
+        self.confidence = confidence
+        self.candidate_ids = candidate_ids
+        self.candidate_factors = candidate_factors
+
+    @classmethod
+    def from_frame(
+        cls,
+        item_factors: pd.DataFrame,
+        regularization: float,
+        confidence: float,
+        popular_items: np.ndarray,
+        max_candidates: int
+    ) -> 'ItemFactorsStore':
+        """
+        Build store from a table with columns (item_id, factors), where
+        factors is a list of item factors, and ALS model parameters.
+        Candidates are the first max_candidates items having factors
+        of popular_items (item ids sorted by descending popularity).
+        """
+
+        item_factors = item_factors.sort_values(by='item_id')
+        factors = (
+            np.stack(item_factors['factors'].to_numpy()).astype('float32')
+            if len(item_factors) else np.zeros((0, 0), dtype='float32')
+        )
+        item_ids = item_factors['item_id'].to_numpy(dtype='int32')
+
+        # NB: считаем в float64, чтобы не накапливать ошибку округления
+        gram = factors.T.astype('float64') @ factors
+        gram[np.diag_indices_from(gram)] += regularization
+
+        # Кандидаты - самые популярные товары, для которых есть факторы
+        pos = find_sorted(
+            item_ids, np.asarray(popular_items, dtype='int64')
+        )
+        candidates = pos[pos >= 0][:max_candidates]
+
+        return cls(
+            item_ids=item_ids,
+            factors=factors,
+            gram=gram.astype('float32'),
+            confidence=np.array(confidence, dtype='float32'),
+            candidate_ids=item_ids[candidates],
+            candidate_factors=factors[candidates]
+        )
+
+    @classmethod
+    def empty(cls) -> 'ItemFactorsStore':
+        """Get an empty store (fold-in is disabled)."""
+
+        return cls.from_frame(
+            pd.DataFrame({'item_id': [], 'factors': []}), 0., 1., [], 0
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Get arrays the store is built of (see `__init__`)."""
+
+        return {
+            'item_ids': self.item_ids,
+            'factors': self.factors,
+            'gram': self.gram,
+            'confidence': self.confidence,
+            'candidate_ids': self.candidate_ids,
+            'candidate_factors': self.candidate_factors
+        }
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def fold_in(self, item_ids: np.ndarray) -> np.ndarray | None:
+        """
+        Get user factors from ids of items the user interacted with
+        (None if there are no items with factors among them).
+
+        Solves (YᵀY + regularization·I + Σ(c - 1)·yyᵀ)·x = Σc·y, where
+        sums are over the user's items (c - confidence).
+        """
+
+        pos = find_sorted(self.item_ids, item_ids)
+        pos = np.unique(pos[pos >= 0])
+        if not len(pos):
+            return None
+
+        user_items = self.factors[pos]
+        confidence = float(self.confidence)
+
+        return np.linalg.solve(
+            self.gram + (confidence - 1) * (user_items.T @ user_items),
+            confidence * user_items.sum(axis=0)
+        ).astype('float32')
+
+    def recommend(self, user_factors: np.ndarray, n_recs: int) -> np.ndarray:
+        """
+        Get top n_recs candidates by score (dot product) for each row of
+        user_factors: array of shape (n_users, n_recs), each row sorted
+        by descending score.
+        """
+
+        n_recs = min(n_recs, len(self.candidate_ids))
+        recs = np.zeros((len(user_factors), n_recs), dtype='int32')
+        if not n_recs:
+            return recs
+
+        # NB: скоры считаем отдельно для каждого пользователя (матрично-
+        # векторным умножением): результат не зависит от состава батча,
+        # в памяти - скоры только одного пользователя
+        for i, factors in enumerate(user_factors):
+            scores = self.candidate_factors @ factors
+
+            # Отбираем n_recs лучших товаров без полной сортировки,
+            # затем сортируем только их
+            top = np.argpartition(-scores, n_recs - 1)[:n_recs]
+            recs[i] = self.candidate_ids[
+                top[np.argsort(-scores[top], kind='stable')]
+            ]
+
+        return recs
+
+
+class ItemNeighboursStore:
+    """
+    Pre-calculated item-to-item recommendations (most similar items)
+    stored as a fixed-width array.
+
+    Attributes:
+        - **item_ids** - sorted int32 array of items having neighbours
+
+        - **neighbours** - int32 array of shape (len(item_ids), k):
+        `neighbours[i]` are neighbours of `item_ids[i]` sorted by
+        descending similarity, padded with MISSING if there are less than k
+    """
+
+    # Значение-заполнитель для недостающих соседей
+    MISSING = -1
+
+    def __init__(self, item_ids: np.ndarray, neighbours: np.ndarray):
+        self.item_ids = item_ids
+        self.neighbours = neighbours
+
+    @classmethod
+    def from_frame(cls, neighbours: pd.DataFrame) -> 'ItemNeighboursStore':
+        """
+        Build store from a table with columns (item_id, neighbour_id, score).
+        """
+
+        item_ids = neighbours['item_id'].to_numpy(dtype='int64')
+        scores = neighbours['score'].to_numpy(dtype='float32')
+
+        # Сортируем по item_id, внутри товара - по убыванию score
+        order = np.lexsort((-scores, item_ids))
+        item_ids = item_ids[order]
+
+        unique_item_ids, starts, counts = np.unique(
+            item_ids, return_index=True, return_counts=True
+        )
+
+        # Раскладываем соседей в строки массива фиксированной ширины
+        rows = np.repeat(np.arange(len(unique_item_ids)), counts)
+        cols = np.arange(len(item_ids)) - np.repeat(starts, counts)
+        array = np.full(
+            (len(unique_item_ids), counts.max() if len(counts) else 0),
+            cls.MISSING,
+            dtype='int32'
+        )
+        array[rows, cols] = (
+            neighbours['neighbour_id'].to_numpy(dtype='int32')[order]
+        )
+
+        return cls(item_ids=unique_item_ids.astype('int32'), neighbours=array)
+
+    @classmethod
+    def empty(cls) -> 'ItemNeighboursStore':
+        """Get an empty store (item-to-item recs are disabled)."""
+
+        return cls.from_frame(
+            pd.DataFrame({'item_id': [], 'neighbour_id': [], 'score': []})
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Get arrays the store is built of (see `__init__`)."""
+
+        return {'item_ids': self.item_ids, 'neighbours': self.neighbours}
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def find_many(self, item_ids: np.ndarray) -> np.ndarray:
+        """Return positions of items in `item_ids` (-1 for not found)."""
+
+        return find_sorted(self.item_ids, item_ids)
+
+    def get_items_at(self, pos: int, n_recs: int) -> np.ndarray:
+        """Get top n_recs neighbours of item at position pos (-1 for none)."""
+
+        if pos < 0:
+            return self.neighbours.ravel()[:0]
+
+        items = self.neighbours[pos, :n_recs]
+        if items[-1] == self.MISSING:
+            items = items[items != self.MISSING]
+
+        return items
+
+
+class TopPopularStore:
+    """
+    Pre-calculated top-popular items, global and per category.
+
+    Attributes:
+        - **global_items** - int32 array of top items over all categories
+        sorted by descending score
+
+        - **category_ids** - sorted array of categories having top items
+
+        - **category_indptr** - offsets array: top items of
+        `category_ids[i]` are stored at positions
+        `category_indptr[i]:category_indptr[i + 1]` of `category_items`
+
+        - **category_items** - flat int32 array of top items, for each
+        category sorted by descending score
+    """
+
+    def __init__(
+        self,
+        global_items: np.ndarray,
+        category_ids: np.ndarray,
+        category_indptr: np.ndarray,
+        category_items: np.ndarray
+    ):
+        self.global_items = global_items
+        self.category_ids = category_ids
+        self.category_indptr = category_indptr
+        self.category_items = category_items
+
+        # Словарь формата {category_id: массив топ-популярных в категории},
+        # NB: массивы - срезы (views) без копирования данных
+        self._items_by_category = {
+            category_id: category_items[start:end]
+            for category_id, start, end in zip(
+                category_ids.tolist(),
+                category_indptr[:-1].tolist(),
+                category_indptr[1:].tolist()
+            )
+        }
+
+    @classmethod
+    def from_frame(
+        cls,
+        top_popular: pd.DataFrame,
+        max_n: int
+    ) -> 'TopPopularStore':
+        """
+        Build store from a table with columns (item_id, score, category_id)
+        keeping at most max_n items per category (and globally).
+        """
+
+        # Глобально сортируем по убыванию score
+        top_popular = top_popular.sort_values(by='score', ascending=False)
+        items = top_popular['item_id'].to_numpy(dtype='int32')
+        categories = top_popular['category_id'].to_numpy(dtype='int64')
+
+        # Стабильная сортировка по категории сохраняет порядок по score
+        # внутри каждой категории
+        order = np.argsort(categories, kind='stable')
+        category_ids, starts, counts = np.unique(
+            categories[order], return_index=True, return_counts=True
+        )
+
+        # Оставляем не более max_n товаров в каждой категории
+        counts = np.minimum(counts, max_n)
+        category_indptr = np.zeros(len(category_ids) + 1, dtype='int64')
+        np.cumsum(counts, out=category_indptr[1:])
+        positions = (
+            np.repeat(starts - category_indptr[:-1], counts)
+            + np.arange(category_indptr[-1])
+        )
+
+        return cls(
+            global_items=items[:max_n].copy(),
+            category_ids=category_ids,
+            category_indptr=category_indptr,
+            category_items=items[order[positions]]
+        )
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Get arrays the store is built of (see `__init__`)."""
+
+        return {
+            'global_items': self.global_items,
+            'category_ids': self.category_ids,
+            'category_indptr': self.category_indptr,
+            'category_items': self.category_items
+        }
+
+    def get_items(self, n_recs: int, category_id: int | None) -> np.ndarray:
+        """
+        Get top n_recs items by category or globaly if category_id is None
+        (empty array for unknown category).
+        """
+
+        if category_id is None:
+            return self.global_items[:n_recs]
+
+        category_items = self._items_by_category.get(category_id)
+        if category_items is None:
+            return self.global_items[:0]
+
+        return category_items[:n_recs]
@@ -0,0 +1,104 @@
+import random
+import time
+from bisect import bisect_left
+
+from prometheus_client import Histogram
+
+# Верхние границы корзин n_recs для метки n_recs_bucket
+N_RECS_BUCKETS = (1, 5, 10, 20, 50, 100)
+
+
+def n_recs_bucket(n_recs: int) -> str:
+    """Get n_recs bucket label: '<=10', '<=20', ..., '>100'."""
+
+    i = bisect_left(N_RECS_BUCKETS, n_recs)
+    if i == len(N_RECS_BUCKETS):
+        return f'>{N_RECS_BUCKETS[-1]}'
+
+    return f'<={N_RECS_BUCKETS[i]}'
+
+
+class PhaseTimer:
+    """
+    Measure durations of consecutive phases of a single call: each `mark`
+    records time elapsed since the previous mark (or timer creation).
+
+    Attributes:
+        - **durations** - {phase: duration (sec)}, phases in order
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self._t_start = self._t_last = time.perf_counter()
+
+    def mark(self, phase: str):
+        """Record duration of the phase which has just finished."""
+
+        now = time.perf_counter()
+        self.durations[phase] = now - self._t_last
+        self._t_last = now
+
+    @property
+    def total(self) -> float:
+        """Time (sec) elapsed from timer creation till the last mark."""
+
+        return self._t_last - self._t_start
+
+
+class HandlerMetrics:
+    """
+    Sampled latency metrics of recommendation handler phases.
+
+    Only a sample_rate fraction of calls is measured, so the overhead for
+    other calls is a single random number; with sample_rate=0 the handler
+    should not be given metrics at all.
+
+    Attributes:
+        - **sample_rate** - fraction of measured calls, (0, 1]
+
+        - **metric_phase_duration** - histogram of phase durations (sec)
+        labeled with method (single | batch) and phase
+
+        - **metric_recs_duration** - histogram of single request handling
+        durations (sec) labeled with recommendations source and n_recs
+        bucket (see `n_recs_bucket`)
+    """
+
+    def __init__(
+        self,
+        sample_rate: float,
+        metric_phase_duration: Histogram,
+        metric_recs_duration: Histogram
+    ):
+        self.sample_rate = sample_rate
+        self.metric_phase_duration = metric_phase_duration
+        self.metric_recs_duration = metric_recs_duration
+
+    def start(self) -> PhaseTimer | None:
+        """Get a timer if the call is sampled, None otherwise."""
+
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return PhaseTimer()
+        return None
+
+    def observe(
+        self,
+        timer: PhaseTimer,
+        method: str,
+        source: str | None = None,
+        n_recs: int | None = None
+    ):
+        """
+        Observe phase durations of the timer and, for single requests
+        (source is given), total duration by source and n_recs bucket.
+        """
+
+        for phase, duration in timer.durations.items():
+            self.metric_phase_duration.labels(
+                method=method, phase=phase
+            ).observe(duration)
+
+        if source is not None:
+            self.metric_recs_duration.labels(
+                source=source, n_recs_bucket=n_recs_bucket(n_recs)
+            ).observe(timer.total)
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Переходим в директорию скрипта
+cd $(dirname $0)
+
+# Парсим файл с переменными окружения для сервиса
+export $(grep -v '^#' .env_service | xargs)
+
+# Продуктовый запуск: APP_WORKERS процессов, разделяющих данные
+# рекомендаций через отображаемые в память файлы бандла
+python app/launcher.py --host=$SERVICE_HOST --port=$APP_PORT_EXTERNAL
@@ -0,0 +1,376 @@
+import argparse
+import json
+import resource
+import sys
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+tests_dir = Path(__file__).parent
+
+# Импортируем тестируемый хендлер из кода приложения
+sys.path.insert(0, str(tests_dir.parent / 'app'))
+from core import RecSysHandler  # noqa: E402
+
+# Файл с базовыми значениями метрик (для каждого масштаба данных)
+BASELINE_PATH = tests_dir / 'handler_benchmark_baseline.json'
+
+# Кол-во рекомендаций в запросах бенчмарка и кол-во последних товаров
+N_RECS = 10
+N_LAST_ITEMS = 3
+
+RANDOM_STATE = 42
+
+SEP = '-' * 50
+
+
+def get_scale(args: argparse.Namespace) -> dict:
+    """Get synthetic data scale parameters."""
+
+    return {
+        'users': args.users,
+        'recs': args.recs,
+        'items': args.items,
+        'categories': args.categories,
+        'factors': args.factors,
+        'neighbours': args.neighbours
+    }
+
+
+def get_scale_key(scale: dict) -> str:
+    """Get scale key used to store baselines, e.g. 'users=1000,recs=50'."""
+
+    return ','.join(f'{name}={value}' for name, value in scale.items())
+
+
+def generate_data(data_dir: Path, scale: dict):
+    """
+    Generate synthetic recommendations files of the given scale (files
+    already generated for the same scale are reused):
+        - items_train.parquet - items catalog (item_id, category_id)
+
+        - top_popular.parquet - all items by descending popularity
+        (item_id, score, category_id)
+
+        - weighted_als.parquet - `recs` personal recs for each of
+        `users` users (user_id, item_id, score)
+
+        - als_item_factors.parquet - ALS item factors (item_id, factors),
+        if `factors` > 0
+
+        - item_neighbours.parquet - `neighbours` similar items for each
+        item (item_id, neighbour_id, score), if `neighbours` > 0
+    """
+
+    scale_file = data_dir / 'scale.json'
+    if scale_file.exists() and json.loads(scale_file.read_text()) == scale:
+        print(f'Using synthetic data generated in {data_dir}')
+        return
+
+    print(f'Generating synthetic data in {data_dir}: {get_scale_key(scale)}')
+    data_dir.mkdir(parents=True, exist_ok=True)
+    scale_file.unlink(missing_ok=True)
+    rng = np.random.default_rng(RANDOM_STATE)
+
+    n_items = scale['items']
+    item_ids = np.arange(n_items, dtype='int32')
+    categories = rng.integers(
+        0, scale['categories'], n_items, dtype='int32'
+    )
+    pd.DataFrame({
+        'item_id': item_ids,
+        'category_id': categories
+    }).to_parquet(data_dir / 'items_train.parquet')
+
+    # Популярность товаров - распределение Ципфа
+    order = rng.permutation(n_items).astype('int32')
+    pd.DataFrame({
+        'item_id': order,
+        'score': (1 / np.arange(1, n_items + 1)).astype('float32'),
+        'category_id': categories[order]
+    }).to_parquet(data_dir / 'top_popular.parquet')
+
+    n_users, n_recs = scale['users'], scale['recs']
+    pd.DataFrame({
+        'user_id': np.repeat(np.arange(n_users, dtype='int32'), n_recs),
+        'item_id': rng.integers(0, n_items, n_users * n_recs, dtype='int32'),
+        'score': np.tile(
+            np.linspace(1, 0, n_recs, dtype='float32'), n_users
+        )
+    }).to_parquet(data_dir / 'weighted_als.parquet')
+
+    if scale['factors'] > 0:
+        factors = rng.normal(
+            0, 1, (n_items, scale['factors'])
+        ).astype('float32')
+        frame = pd.DataFrame({'item_id': item_ids, 'factors': list(factors)})
+        frame.attrs = {'regularization': 0.05, 'confidence': 0.25}
+        frame.to_parquet(data_dir / 'als_item_factors.parquet')
+
+    n_neighbours = scale['neighbours']
+    if n_neighbours > 0:
+        pd.DataFrame({
+            'item_id': np.repeat(item_ids, n_neighbours),
+            'neighbour_id': rng.integers(
+                0, n_items, n_items * n_neighbours, dtype='int32'
+            ),
+            'score': np.tile(
+                np.linspace(1, 0, n_neighbours, dtype='float32'), n_items
+            )
+        }).to_parquet(data_dir / 'item_neighbours.parquet')
+
+    # Отметка о завершении генерации - последней
+    scale_file.write_text(json.dumps(scale))
+
+
+def get_rss_mb() -> float:
+    """Get current resident set size (MB) of the process."""
+
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+
+    return float('nan')
+
+
+def get_latency_ms(func, calls: list[dict]) -> np.ndarray:
+    """Call func with each of kwargs in calls, get latencies (ms)."""
+
+    latencies = np.empty(len(calls))
+    for i, kwargs in enumerate(calls):
+        start = time.perf_counter()
+        func(**kwargs)
+        latencies[i] = time.perf_counter() - start
+
+    return latencies * 1000
+
+
+def get_latency_percentiles(
+    func,
+    calls: list[dict],
+    repeats: int
+) -> tuple[float, float]:
+    """
+    Get (p50, p99) latencies (ms) of calls: the minimum over `repeats`
+    runs of all calls (the first run is a warm up and is not counted),
+    which is less sensitive to noise from other processes.
+    """
+
+    get_latency_ms(func, calls)
+    percentiles = np.array([
+        np.percentile(get_latency_ms(func, calls), [50, 99])
+        for _ in range(repeats)
+    ])
+
+    return tuple(percentiles.min(axis=0))
+
+
+def run_measurements(data_dir: Path, scale: dict, args: dict) -> dict:
+    """
+    Load data to a handler and measure latencies.
+    NB: runs in a separate (spawned) process for clean RSS measurements.
+    """
+
+    def path(name):
+        file = data_dir / name
+        return str(file) if file.exists() else None
+
+    handler = RecSysHandler(
+        path_recs_top_popular=path('top_popular.parquet'),
+        path_recs_personal=path('weighted_als.parquet'),
+        path_items_train=path('items_train.parquet'),
+        path_item_factors=path('als_item_factors.parquet'),
+        path_item_neighbours=path('item_neighbours.parquet')
+    )
+
+    results = {}
+    rss_before = get_rss_mb()
+    start = time.perf_counter()
+    handler.load_data()
+    results['load_data_sec'] = time.perf_counter() - start
+    results['data_rss_mb'] = get_rss_mb() - rss_before
+    # NB: на linux ru_maxrss - в килобайтах
+    results['peak_rss_mb'] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    )
+
+    rng = np.random.default_rng(RANDOM_STATE)
+
+    def get_calls(n_calls, cold):
+        # 'Теплые' пользователи - с персональными рекомендациями,
+        # 'холодные' - без них (рекомендации по последним товарам)
+        user_ids = rng.integers(0, scale['users'], n_calls)
+        if cold:
+            user_ids += scale['users']
+        last_items = rng.integers(
+            0, scale['items'], (n_calls, N_LAST_ITEMS)
+        )
+        return [
+            {'user_id': int(user_id), 'n_recs': N_RECS,
+             'last_items': items.tolist()}
+            for user_id, items in zip(user_ids, last_items)
+        ]
+
+    for users in ('warm', 'cold'):
+        cold = users == 'cold'
+
+        # Одиночные запросы
+        (
+            results[f'single_{users}_p50_ms'],
+            results[f'single_{users}_p99_ms']
+        ) = get_latency_percentiles(
+            handler.get_recs, get_calls(args['n_calls'], cold),
+            args['repeats']
+        )
+
+        # Батчи запросов
+        batch_calls = []
+        for _ in range(args['n_batches']):
+            calls = get_calls(args['batch_size'], cold)
+            batch_calls.append({
+                'user_ids': [call['user_id'] for call in calls],
+                'n_recs': [call['n_recs'] for call in calls],
+                'last_items': [call['last_items'] for call in calls]
+            })
+        (
+            results[f'batch_{users}_p50_ms'],
+            results[f'batch_{users}_p99_ms']
+        ) = get_latency_percentiles(
+            handler.get_recs_batch, batch_calls, args['repeats']
+        )
+
+    return {name: float(value) for name, value in results.items()}
+
+
+def check_baseline(
+    results: dict,
+    baseline: dict | None,
+    tolerance: float
+) -> list[str]:
+    """
+    Print results vs baseline, get names of regressed metrics: metrics
+    exceeding baseline values by more than `tolerance` (relative).
+    """
+
+    regressions = []
+    print(f'{"metric":<22} {"value":>10} {"baseline":>10} {"change":>8}')
+    print(SEP)
+
+    for name, value in results.items():
+        base = (baseline or {}).get(name)
+        if base is None:
+            print(f'{name:<22} {value:>10.3f}')
+            continue
+
+        change = value / base - 1 if base > 0 else 0
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(
+            f'{name:<22} {value:>10.3f} {base:>10.3f} {change:>+8.0%}'
+            + ('  <-- REGRESSION' if regressed else '')
+        )
+
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark RecSysHandler on synthetic data: data load '
+        'time and memory, single and batch get_recs latency'
+    )
+    parser.add_argument(
+        '--data-dir', type=Path, default=Path('/tmp/recsys_benchmark_data'),
+        help='Directory for generated synthetic data'
+    )
+    parser.add_argument('--users', type=int, default=1_000_000,
+                        help='Number of users with personal recs')
+    parser.add_argument('--recs', type=int, default=50,
+                        help='Number of personal recs per user')
+    parser.add_argument('--items', type=int, default=400_000,
+                        help='Number of items in catalog')
+    parser.add_argument('--categories', type=int, default=1700,
+                        help='Number of item categories')
+    parser.add_argument('--factors', type=int, default=64,
+                        help='Number of ALS factors, 0 - without fold-in')
+    parser.add_argument('--neighbours', type=int, default=20,
+                        help='Number of similar items per item, 0 - without '
+                        'similar items')
+    parser.add_argument('--n-calls', type=int, default=2000,
+                        help='Number of measured single requests')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of requests in a batch')
+    parser.add_argument('--n-batches', type=int, default=20,
+                        help='Number of measured batches')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of measurement runs (min is taken)')
+    parser.add_argument(
+        '--baseline', type=Path, default=BASELINE_PATH,
+        help='JSON file with baseline metrics values (per data scale)'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=0.3,
+        help='Max allowed relative increase of metrics over baseline'
+    )
+    parser.add_argument(
+        '--update-baseline', action='store_true',
+        help='Save results as baseline for the data scale'
+    )
+
+    return parser.parse_args()
+
+
+def run_benchmark():
+    """
+    Run benchmark: exit code is 1 if any metric regressed compared to
+    the stored baseline for the same data scale.
+    """
+
+    args = parse_args()
+    scale = get_scale(args)
+    scale_key = get_scale_key(scale)
+
+    generate_data(args.data_dir, scale)
+
+    # Замеры - в отдельном процессе (без памяти, занятой генерацией)
+    with get_context('spawn').Pool(1) as pool:
+        results = pool.apply(run_measurements, (args.data_dir, scale, {
+            'n_calls': args.n_calls,
+            'batch_size': args.batch_size,
+            'n_batches': args.n_batches,
+            'repeats': args.repeats
+        }))
+
+    baselines = (
+        json.loads(args.baseline.read_text()) if args.baseline.exists()
+        else {}
+    )
+
+    print(SEP)
+    print(f'Data scale: {scale_key}')
+    print(SEP)
+    regressions = check_baseline(
+        results, baselines.get(scale_key), args.tolerance
+    )
+    print(SEP)
+
+    if args.update_baseline:
+        baselines[scale_key] = results
+        args.baseline.write_text(json.dumps(baselines, indent=4) + '\n')
+        print(f'Baseline saved to {args.baseline}')
+    elif scale_key not in baselines:
+        print('No baseline for the data scale, use --update-baseline')
+    elif regressions:
+        print(f'Regressions (>{args.tolerance:.0%}): {", ".join(regressions)}')
+        sys.exit(1)
+    else:
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -1,64 +1,326 @@
+import argparse
+import asyncio
 import json
 import os
 import random
 import time
+from collections import Counter
+from datetime import datetime
 from pathlib import Path
 
-import requests
+import aiohttp
+import numpy as np
 from dotenv import load_dotenv
 
 tests_dir = Path(__file__).parent
 
-# Определяем URI сервиса по настройкам в .env_service
+# Определяем адрес сервиса по настройкам в .env_service
 load_dotenv(tests_dir.parent / '.env_service')
-service_uri = (
-    f"http://{os.getenv('SERVICE_HOST')}:{os.getenv('APP_PORT_EXTERNAL')}/recs"
+service_url = (
+    f"http://{os.getenv('SERVICE_HOST')}:{os.getenv('APP_PORT_EXTERNAL')}"
 )
 
-# Максимальное число запросов в одном 'пакете'
-MAX_REQUEST_VOLLEY = 1000
+# Границы (мс) корзин гистограммы задержек в отчете
+LATENCY_BUCKETS_MS = (
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000
+)
 
-# Максимальный таймаут между 'пакетами' запросов (сек)
-MAX_TIMEOUT = 30
+SEP = '-' * 40
 
-SEP = '-' * 40 + '\n'
 
-# Загружаем примеры запросов из юнит-тестов
-with open(tests_dir / 'test_data.json', 'r') as f:
-    test_data = json.load(f)
+def load_request_mix(path: Path) -> list[tuple[str, bytes]]:
+    """
+    Load request mix: a list of (uri, json body) pairs.
 
-# Оставим только запросы c валидными данными (проверять стабильность
-# сериализации с помощью стандартных методов fastapi/pydantc не будем ;)
-valid_requests = [
-    json.dumps(test['data']) for test in test_data
-    if test['uri'] == '/recs' and test["response_code"] == 200
-]
+    Supported formats:
+        - .json - unit tests data (see test_data.json): only POST requests
+        expected to succeed (response code 200) are used
 
-print(f'Taregtng application at: {service_uri}')
+        - .jsonl - one request per line: either an object with keys
+        (uri, data) or just a /recs request body
+    """
 
-while True:
-    volley_size = random.randint(0, MAX_REQUEST_VOLLEY)
-    print(SEP + f'Running a series of {volley_size} requests... ', end='')
+    if path.suffix == '.jsonl':
+        with open(path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        records = [
+            record if 'data' in record else {'uri': '/recs', 'data': record}
+            for record in records
+        ]
+    else:
+        with open(path, 'r') as f:
+            records = [
+                test for test in json.load(f)
+                if test['method'] == 'post' and test['response_code'] == 200
+            ]
 
-    t_start = time.time()
+    mix = [
+        (record['uri'], json.dumps(record['data']).encode())
+        for record in records
+    ]
 
-    for data in random.choices(valid_requests, k=volley_size):
-        response = requests.post(
-            service_uri,
-            headers={'Content-type': 'application/json',
-                     'Accept': 'application/json'},
-            data=data
+    if not mix:
+        raise ValueError(f'No valid requests found in {path}')
+
+    return mix
+
+
+class LoadStats:
+    """Latencies (sec) and response statuses collected per uri."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, uri: str, latency: float, status: str):
+        self.latencies.setdefault(uri, []).append(latency)
+        self.statuses.setdefault(uri, Counter())[status] += 1
+
+    @staticmethod
+    def summarize(latencies: list[float], statuses: Counter) -> dict:
+        """Latency percentiles and histogram (ms), error rate."""
+
+        latencies_ms = np.asarray(latencies) * 1000
+        n_requests = len(latencies_ms)
+        n_errors = n_requests - statuses.get('200', 0)
+
+        p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+        counts, _ = np.histogram(
+            latencies_ms, bins=(0,) + LATENCY_BUCKETS_MS + (np.inf,)
         )
-        if response.status_code == 200:
+
+        return {
+            'requests': n_requests,
+            'errors': n_errors,
+            'error_rate': n_errors / n_requests,
+            'statuses': dict(statuses),
+            'latency_ms': {
+                'mean': float(latencies_ms.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99),
+                'max': float(latencies_ms.max()),
+            },
+            # Число запросов с задержкой не более (le) границы корзины
+            'latency_histogram_ms': {
+                'le': [*LATENCY_BUCKETS_MS, 'inf'],
+                'counts': np.cumsum(counts).tolist(),
+            }
+        }
+
+    def report(self, duration: float) -> dict:
+        """Build report: summary over all requests and per uri."""
+
+        all_latencies = [
+            latency for latencies in self.latencies.values()
+            for latency in latencies
+        ]
+        all_statuses = sum(self.statuses.values(), Counter())
+
+        if not all_latencies:
+            return {'duration': duration, 'achieved_rps': 0}
+
+        return {
+            'duration': duration,
+            'achieved_rps': len(all_latencies) / duration,
+            'total': self.summarize(all_latencies, all_statuses),
+            'by_uri': {
+                uri: self.summarize(self.latencies[uri], self.statuses[uri])
+                for uri in sorted(self.latencies)
+            }
+        }
+
+
+async def send_request(
+    session: aiohttp.ClientSession,
+    uri: str,
+    body: bytes,
+    scheduled: float,
+    stats: LoadStats
+):
+    """
+    Send request and record its latency measured from the scheduled start
+    time, so that time spent waiting for a free connection is included.
+    """
+
+    try:
+        async with session.post(
+            service_url + uri,
+            data=body,
+            headers={'Content-type': 'application/json',
+                     'Accept': 'application/json'}
+        ) as response:
+            await response.read()
+            status = str(response.status)
+    except asyncio.TimeoutError:
+        status = 'timeout'
+    except aiohttp.ClientError as exc:
+        status = type(exc).__name__
+
+    stats.add(uri, time.perf_counter() - scheduled, status)
+
+
+async def run_open_loop(
+    session: aiohttp.ClientSession,
+    mix: list[tuple[str, bytes]],
+    rps: float,
+    duration: float,
+    concurrency: int,
+    stats: LoadStats
+):
+    """
+    Open-loop load: requests are started at a fixed target rate (with
+    exponentially distributed intervals) regardless of how fast the
+    service responds, with at most `concurrency` requests in flight.
+    """
+
+    in_flight = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def send(uri: str, body: bytes, scheduled: float):
+        async with in_flight:
+            await send_request(session, uri, body, scheduled, stats)
+
+    t_start = time.perf_counter()
+    scheduled = t_start
+
+    while scheduled - t_start < duration:
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        task = asyncio.create_task(send(*random.choice(mix), scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+        scheduled += random.expovariate(rps)
+
+    await asyncio.gather(*tasks)
+
+
+async def run_closed_loop(
+    session: aiohttp.ClientSession,
+    mix: list[tuple[str, bytes]],
+    duration: float,
+    concurrency: int,
+    stats: LoadStats
+):
+    """
+    Closed-loop load: `concurrency` clients send requests one after
+    another as fast as the service responds (saturation test).
+    """
+
+    t_end = time.perf_counter() + duration
+
+    async def client():
+        while (scheduled := time.perf_counter()) < t_end:
+            await send_request(session, *random.choice(mix), scheduled, stats)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    """Run load test and return report."""
+
+    mix = load_request_mix(args.mix)
+    stats = LoadStats()
+    started_at = datetime.now().isoformat(timespec='seconds')
+
+    print(f'Targeting application at: {service_url}')
+    print(
+        f'{len(mix)} distinct requests, concurrency {args.concurrency}, '
+        + (f'target {args.rps} rps' if args.rps > 0 else 'closed loop')
+        + f', duration {args.duration}s'
+    )
+
+    async with aiohttp.ClientSession(
+        # Пул соединений, переиспользуемых между запросами
+        connector=aiohttp.TCPConnector(limit=args.concurrency),
+        timeout=aiohttp.ClientTimeout(total=args.timeout)
+    ) as session:
+        t_start = time.perf_counter()
+        if args.rps > 0:
+            await run_open_loop(session, mix, args.rps, args.duration,
+                                args.concurrency, stats)
+        else:
+            await run_closed_loop(session, mix, args.duration,
+                                  args.concurrency, stats)
+        duration = time.perf_counter() - t_start
+
+    return {
+        'started_at': started_at,
+        'service_url': service_url,
+        'mix': str(args.mix),
+        'concurrency': args.concurrency,
+        'target_rps': args.rps,
+        **stats.report(duration)
+    }
+
+
+def print_report(report: dict):
+    """Print report summary."""
+
+    print(SEP)
+    print(f"Done in {report['duration']:.1f}s at "
+          f"{report['achieved_rps']:.1f} rps")
+
+    for name, summary in [('total', report.get('total')),
+                          *report.get('by_uri', {}).items()]:
+        if summary is None:
             continue
-        print('\n Наташа, мы его уронили...')
-        print(f'Status code: {response.status_code}', end='')
-        print(f'Body: {response.json()}')
+        latency = summary['latency_ms']
+        print(
+            f"{name:<12} requests {summary['requests']:>7}, "
+            f"errors {summary['error_rate']:>6.2%} | latency ms: "
+            f"p50 {latency['p50']:.1f}, p95 {latency['p95']:.1f}, "
+            f"p99 {latency['p99']:.1f}, max {latency['max']:.1f}"
+        )
+        if summary['errors']:
+            print(f"{'':<12} statuses: {summary['statuses']}")
+
+
+def main():
+    """
+    Load test of the recommendation service: concurrent requests drawn
+    from a request mix, report with latency percentiles and error rates.
+    """
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        '--mix', type=Path, default=tests_dir / 'test_data.json',
+        help='request mix: unit tests data (.json) or requests (.jsonl)'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=32,
+        help='max number of requests in flight (connections)'
+    )
+    parser.add_argument(
+        '--rps', type=float, default=0,
+        help='target requests per second (open loop), 0 - closed loop'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=30, help='test duration (sec)'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=10, help='request timeout (sec)'
+    )
+    parser.add_argument(
+        '--output', type=Path, default=Path('load_results.json'),
+        help='path to JSON file with results'
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    report = asyncio.run(run_load(args))
+    print_report(report)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
 
-    duration = time.time() - t_start
+    print(f'Results saved to: {args.output}')
 
-    print(f'done in {duration:.2f}s at {volley_size / duration:.1f} rps')
 
-    sleep_time = random.randint(0, MAX_TIMEOUT)
-    print(f'Sleeping for {sleep_time} seconds...')
-    time.sleep(sleep_time)
+if __name__ == '__main__':
+    main()
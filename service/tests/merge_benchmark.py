@@ -0,0 +1,106 @@
+import json
+import random
+import sys
+import timeit
+from itertools import zip_longest
+from pathlib import Path
+
+import pandas as pd
+
+tests_dir = Path(__file__).parent
+
+# Импортируем тестируемую функцию из кода приложения
+sys.path.insert(0, str(tests_dir.parent / 'app'))
+from core import interleave_unique  # noqa: E402
+
+# Кол-во повторов прогона всей смеси запросов
+N_REPEATS = 200
+
+# Размер 'каталога' товаров, из которого генерируются списки кандидатов
+# (небольшой, чтобы списки пересекались и были дубликаты)
+N_ITEMS = 300
+
+SEP = '-' * 40
+
+
+def pandas_interleave_unique(lists: list[list[int]], n_recs: int) -> list[int]:
+    """Previous implementation: interleave, then pd.Series.drop_duplicates."""
+
+    merged = [item for items_tuple in zip_longest(*lists)
+              for item in items_tuple if item is not None]
+
+    return pd.Series(merged).drop_duplicates().head(n_recs).tolist()
+
+
+def get_request_mix() -> list[dict]:
+    """Get valid /recs requests from test_data.json."""
+
+    with open(tests_dir / 'test_data.json', 'r') as f:
+        test_data = json.load(f)
+
+    return [
+        test['data'] for test in test_data
+        if test['uri'] == '/recs' and test['response_code'] == 200
+    ]
+
+
+def get_merge_inputs(request: dict, rnd: random.Random) -> list[tuple]:
+    """
+    Generate inputs of merge calls made by RecSysHandler.get_recs for the
+    request: online merge (top-popular per each of up to three last
+    categories plus global top) and final merge (online plus personal).
+    """
+
+    n_recs = request.get('n_recs', 10)
+    n_categories = len(set(request.get('last_items', [])[-3:]))
+
+    def top(n):
+        return rnd.sample(range(N_ITEMS), min(n, N_ITEMS))
+
+    online_lists = [top(n_recs) for _ in range(n_categories)] + [top(n_recs)]
+
+    return [
+        (online_lists, n_recs),
+        ([top(n_recs), top(n_recs)], n_recs)
+    ]
+
+
+def run_benchmark():
+    """Compare merge implementations on the test_data.json request mix."""
+
+    rnd = random.Random(0)
+    calls = [
+        call for request in get_request_mix()
+        for call in get_merge_inputs(request, rnd)
+    ]
+
+    # Проверяем, что реализации дают одинаковый результат
+    for lists, n_recs in calls:
+        assert (interleave_unique(lists, n_recs)
+                == pandas_interleave_unique(lists, n_recs))
+
+    print(f'Benchmarking {len(calls)} merge calls x {N_REPEATS} repeats')
+    print(SEP)
+
+    results = {}
+    for name, func in (
+        ('pd.Series.drop_duplicates', pandas_interleave_unique),
+        ('interleave_unique', interleave_unique),
+    ):
+        duration = min(timeit.repeat(
+            lambda: [func(lists, n_recs) for lists, n_recs in calls],
+            number=N_REPEATS,
+            repeat=3
+        ))
+        results[name] = duration / (N_REPEATS * len(calls)) * 1e6
+        print(f'{name:<30} {results[name]:>10.2f} us/call')
+
+    speedup = (
+        results['pd.Series.drop_duplicates'] / results['interleave_unique']
+    )
+    print(SEP)
+    print(f'Speedup: {speedup:.1f}x')
+
+
+if __name__ == '__main__':
+    run_benchmark()
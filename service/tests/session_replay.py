@@ -0,0 +1,420 @@
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+tests_dir = Path(__file__).parent
+service_dir = tests_dir.parent
+
+# Импортируем хендлер из кода приложения
+sys.path.insert(0, str(service_dir / 'app'))
+from core import RecSysHandler  # noqa: E402
+
+# Пути к данным рекомендаций берем из настроек сервиса
+load_dotenv(service_dir / '.env_service')
+
+# Границы (сек) корзин гистограммы задержек: логарифмическая шкала
+# от 1 мкс до 10 сек, 20 корзин на порядок
+LATENCY_BUCKETS = np.logspace(-6, 1, 141)
+
+# Максимальная позиция события в сессии в отчете (дальше - одна группа)
+MAX_SESSION_POSITION = 10
+
+SEP = '-' * 50
+
+
+class LastItemsWindow:
+    """
+    Rolling window of last items of each user stored as a dense array
+    indexed by user id (user ids are compact non-negative integers),
+    together with the time of the last event and the position of the last
+    event in the current session.
+
+    Attributes:
+        - **size** - number of last items kept for each user
+
+        - **session_gap** - max time (sec) between events of a session
+
+        - **items** - int32 array of shape (n, size): last items of each
+        user in chronological order, padded with MISSING at the beginning
+
+        - **last_time** - int64 array of times (ns) of the last events
+        of users (MISSING for users without events)
+
+        - **session_position** - int32 array: position (from 1) of the
+        last event of each user in its session
+    """
+
+    # Значение для пустых позиций окна
+    MISSING = -1
+
+    def __init__(self, size: int, session_gap: float):
+        self.size = size
+        self.session_gap = session_gap
+        self.items = np.full((0, size), self.MISSING, dtype='int32')
+        self.last_time = np.full(0, self.MISSING, dtype='int64')
+        self.session_position = np.zeros(0, dtype='int32')
+
+    def _reserve(self, max_user_id: int):
+        """Grow arrays (at least twice) to fit max_user_id."""
+
+        capacity = len(self.last_time)
+        if max_user_id < capacity:
+            return
+
+        capacity = max(max_user_id + 1, 2 * capacity)
+        n_new = capacity - len(self.last_time)
+        self.items = np.concatenate([
+            self.items,
+            np.full((n_new, self.size), self.MISSING, dtype='int32')
+        ])
+        self.last_time = np.concatenate([
+            self.last_time, np.full(n_new, self.MISSING, dtype='int64')
+        ])
+        self.session_position = np.concatenate([
+            self.session_position, np.zeros(n_new, dtype='int32')
+        ])
+
+    def update(
+        self,
+        user_ids: np.ndarray,
+        item_ids: np.ndarray,
+        times: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Process a chunk of events (in chronological order): get last items
+        of the user before each event (array of shape (n_events, size)) and
+        position of each event in its session, then add events to windows.
+        """
+
+        n_events = len(user_ids)
+        if not n_events:
+            return (
+                np.zeros((0, self.size), dtype='int32'),
+                np.zeros(0, dtype='int32')
+            )
+
+        self._reserve(int(user_ids.max()))
+
+        # Группируем события по пользователям, сохраняя хронологию
+        order = np.argsort(user_ids, kind='stable')
+        users = user_ids[order]
+        items = item_ids[order]
+        times = times[order]
+
+        group_start = np.ones(n_events, dtype=bool)
+        group_start[1:] = users[1:] != users[:-1]
+        start_index = np.maximum.accumulate(
+            np.where(group_start, np.arange(n_events), 0)
+        )
+        # Позиция события среди событий пользователя в части
+        pos = np.arange(n_events) - start_index
+
+        # Окно перед событием: k-й с конца товар - предыдущее событие
+        # пользователя в части, либо товар из окна до начала части
+        windows = np.empty((n_events, self.size), dtype='int32')
+        for k in range(1, self.size + 1):
+            state_pos = np.minimum(self.size - k + pos, self.size - 1)
+            windows[:, self.size - k] = np.where(
+                pos >= k,
+                items[np.maximum(np.arange(n_events) - k, 0)],
+                self.items[users, state_pos]
+            )
+
+        # Позиция в сессии: новая сессия начинается, если с предыдущего
+        # события пользователя прошло более session_gap сек
+        prev_time = np.where(
+            group_start, self.last_time[users], np.roll(times, 1)
+        )
+        new_session = (
+            (prev_time == self.MISSING)
+            | (times - prev_time > self.session_gap * 1e9)
+        )
+        session_start = np.maximum.accumulate(
+            np.where(new_session | group_start, np.arange(n_events), 0)
+        )
+        session_pos = np.arange(n_events) - session_start + np.where(
+            new_session[session_start],
+            1,
+            self.session_position[users] + 1
+        )
+
+        # Обновляем окна по последнему событию каждого пользователя
+        group_end = np.ones(n_events, dtype=bool)
+        group_end[:-1] = group_start[1:]
+        last_users = users[group_end]
+        self.items[last_users, :-1] = windows[group_end, 1:]
+        self.items[last_users, -1] = items[group_end]
+        self.last_time[last_users] = times[group_end]
+        self.session_position[last_users] = session_pos[group_end]
+
+        # Возвращаем результаты в исходном порядке событий
+        result_windows = np.empty_like(windows)
+        result_windows[order] = windows
+        result_session_pos = np.empty_like(session_pos)
+        result_session_pos[order] = session_pos
+
+        return result_windows, result_session_pos
+
+
+def read_events(
+    path: Path,
+    chunk_size: int,
+    max_events: int | None
+) -> Iterator[pd.DataFrame]:
+    """
+    Read events (timestamp, user_id, event, item_id) by chunks, checking
+    that events are sorted by timestamp.
+    """
+
+    n_events = 0
+    last_timestamp = None
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(
+        batch_size=chunk_size,
+        columns=['timestamp', 'user_id', 'event', 'item_id']
+    ):
+        events = batch.to_pandas()
+        if max_events is not None:
+            events = events.iloc[:max_events - n_events]
+
+        timestamps = events['timestamp'].to_numpy(dtype='datetime64[ns]')
+        if np.any(np.diff(timestamps) < np.timedelta64(0)) or (
+            last_timestamp is not None and timestamps[0] < last_timestamp
+        ):
+            raise ValueError(f'Events in {path} are not sorted by timestamp')
+        last_timestamp = timestamps[-1]
+
+        yield events
+
+        n_events += len(events)
+        if max_events is not None and n_events >= max_events:
+            return
+
+
+def get_handler() -> RecSysHandler:
+    """Get handler with data configured for the service (.env_service)."""
+
+    # NB: пути в .env_service заданы относительно директории сервиса
+    handler = RecSysHandler.from_env(base_dir=str(service_dir))
+    handler.load_data()
+
+    return handler
+
+
+def get_percentiles(histogram: np.ndarray) -> dict:
+    """
+    Get latency percentiles (ms) from histogram over LATENCY_BUCKETS:
+    upper bound of the bucket containing the percentile.
+    """
+
+    cumulative = np.cumsum(histogram)
+    if not cumulative[-1]:
+        return {}
+
+    return {
+        f'p{q}': float(LATENCY_BUCKETS[min(
+            np.searchsorted(cumulative, cumulative[-1] * q / 100) + 1,
+            len(LATENCY_BUCKETS) - 1
+        )] * 1000)
+        for q in (50, 95, 99)
+    }
+
+
+def run_replay(args: argparse.Namespace) -> dict:
+    """
+    Replay events: for each event request recommendations for its user with
+    last items seen before the event, the event is a hit if its item is
+    among recommendations.
+    """
+
+    handler = get_handler()
+    window = LastItemsWindow(args.window, args.session_gap)
+
+    # Счетчики попаданий по типу события и по позиции в сессии
+    hits = {}
+    session_hits = np.zeros((MAX_SESSION_POSITION + 1, 2), dtype='int64')
+
+    # Гистограммы задержек: одного запроса (для батчей - среднее
+    # по запросам батча) и вызова хендлера
+    request_latency = np.zeros(len(LATENCY_BUCKETS) - 1, dtype='int64')
+    call_latency = np.zeros(len(LATENCY_BUCKETS) - 1, dtype='int64')
+    total_duration = 0.
+
+    n_events = 0
+    start = time.perf_counter()
+
+    for events in read_events(args.events, args.chunk_size, args.max_events):
+        user_ids = events['user_id'].to_numpy(dtype='int32')
+        item_ids = events['item_id'].to_numpy(dtype='int32')
+        last_items, session_pos = window.update(
+            user_ids,
+            item_ids,
+            events['timestamp'].to_numpy(dtype='datetime64[ns]')
+            .astype('int64')
+        )
+
+        # Последние товары - в хронологическом порядке, без пустых позиций
+        last_items = [
+            [item for item in items if item != LastItemsWindow.MISSING]
+            for items in last_items.tolist()
+        ]
+        user_ids = user_ids.tolist()
+
+        recs = []
+        durations = []
+        for i in range(0, len(user_ids), args.batch_size):
+            batch = slice(i, i + args.batch_size)
+            t_start = time.perf_counter()
+            if args.batch_size == 1:
+                recs.append(handler.get_recs(
+                    user_ids[i], args.n_recs, last_items[i]
+                ))
+            else:
+                recs.extend(handler.get_recs_batch(
+                    user_ids[batch],
+                    [args.n_recs] * len(user_ids[batch]),
+                    last_items[batch]
+                ))
+            durations.append(time.perf_counter() - t_start)
+
+        durations = np.array(durations)
+        batch_sizes = np.diff(
+            np.append(np.arange(0, len(user_ids), args.batch_size),
+                      len(user_ids))
+        )
+        call_latency += np.histogram(durations, LATENCY_BUCKETS)[0]
+        request_latency += np.histogram(
+            np.repeat(durations / batch_sizes, batch_sizes), LATENCY_BUCKETS
+        )[0]
+        total_duration += durations.sum()
+
+        # Попадания: товар события среди рекомендаций
+        is_hit = np.fromiter(
+            (item in items for item, items in zip(item_ids.tolist(), recs)),
+            dtype=bool,
+            count=len(recs)
+        )
+        for event, group in pd.Series(is_hit).groupby(
+            events['event'].astype(str).to_numpy()
+        ):
+            counts = hits.setdefault(event, [0, 0])
+            counts[0] += int(group.sum())
+            counts[1] += len(group)
+        positions = np.minimum(session_pos, MAX_SESSION_POSITION)
+        np.add.at(session_hits, (positions, 0), is_hit)
+        np.add.at(session_hits, (positions, 1), 1)
+
+        n_events += len(events)
+        print(f'Replayed {n_events} events, '
+              f'{n_events / (time.perf_counter() - start):.0f} events/s')
+
+    n_hits = sum(counts[0] for counts in hits.values())
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'events': str(args.events),
+        'n_recs': args.n_recs,
+        'window': args.window,
+        'batch_size': args.batch_size,
+        'n_events': n_events,
+        'n_users': int(np.count_nonzero(
+            window.last_time != LastItemsWindow.MISSING
+        )),
+        'duration': time.perf_counter() - start,
+        'handler_duration': total_duration,
+        'hit_rate': n_hits / n_events if n_events else 0.,
+        'hit_rate_by_event': {
+            event: n / total for event, (n, total) in sorted(hits.items())
+        },
+        'hit_rate_by_session_position': {
+            (f'{position}+' if position == MAX_SESSION_POSITION
+             else str(position)): int(n) / int(total)
+            for position, (n, total) in enumerate(session_hits)
+            if total
+        },
+        'request_latency_ms': get_percentiles(request_latency),
+        'call_latency_ms': get_percentiles(call_latency),
+        'latency_buckets': LATENCY_BUCKETS.tolist(),
+        'request_latency_histogram': request_latency.tolist(),
+        'call_latency_histogram': call_latency.tolist()
+    }
+
+
+def print_report(report: dict):
+    """Print replay report."""
+
+    print(SEP)
+    print(f'Events replayed  : {report["n_events"]} '
+          f'({report["n_users"]} users) in {report["duration"]:.1f}s')
+    print(f'Handler time     : {report["handler_duration"]:.1f}s '
+          f'(batch size {report["batch_size"]})')
+    print(f'Hit rate @{report["n_recs"]:<6} : {report["hit_rate"]:.2%}')
+    print(SEP)
+    print('Hit rate by event type:')
+    for event, hit_rate in report['hit_rate_by_event'].items():
+        print(f'  {event:<16} {hit_rate:.2%}')
+    print('Hit rate by position in session:')
+    for position, hit_rate in report['hit_rate_by_session_position'].items():
+        print(f'  {position:<16} {hit_rate:.2%}')
+    print(SEP)
+    for name in ('request_latency_ms', 'call_latency_ms'):
+        print(f'{name:<18}: ' + ', '.join(
+            f'{q} {value:.3f}' for q, value in report[name].items()
+        ))
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        description='Replay events in timestamp order through RecSysHandler '
+        '(in-process) with rolling last items of each user, report hit rate '
+        'and latency'
+    )
+    parser.add_argument(
+        '--events', type=Path,
+        default=service_dir.parent / 'prod_build/cache/events_test.parquet',
+        help='.parquet file with events sorted by timestamp'
+    )
+    parser.add_argument('--n-recs', type=int, default=10,
+                        help='Number of recommendations per request')
+    parser.add_argument('--window', type=int, default=3,
+                        help='Number of last items passed in requests')
+    parser.add_argument(
+        '--session-gap', type=float, default=1800,
+        help='Max time (sec) between events of the same session'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='Number of requests per handler call (1 - get_recs calls)'
+    )
+    parser.add_argument('--chunk-size', type=int, default=100_000,
+                        help='Number of events read at once')
+    parser.add_argument('--max-events', type=int, default=None,
+                        help='Max number of replayed events')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='JSON file to save full report to')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    assert args.n_recs > 0 and args.window > 0 and args.batch_size > 0
+
+    report = run_replay(args)
+    print_report(report)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Full report saved to {args.output}')
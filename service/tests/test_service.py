@@ -44,7 +44,24 @@ def test_unit(test, strict_mode):
         if strict_mode:
             # Полное совпадение ответа с эталоном
             assert response.json() == test['response_data']
+        elif isinstance(test['response_data'], list):
+            # Батч: кол-во ответов и рекомендаций в каждом соответствует
+            # ожидаемому
+            assert ([len(x['recs']) for x in response.json()]
+                    == [len(x['recs']) for x in test['response_data']])
         else:
             # Кол-во рекомендаций соответствует ожидаемому
             assert (len(response.json()['recs'])
                     == len(test['response_data']['recs']))
+
+
+# Метрики приложения доступны на /metrics при любом способе запуска
+# (uvicorn или app/launcher.py с любым кол-вом воркеров)
+def test_metrics():
+    response = requests.get(url=(service_uri + '/metrics'))
+    assert response.status_code == requests.codes['ok']
+
+    # Версия данных задается при загрузке данных каждым воркером
+    metrics = [line.split(maxsplit=1) for line in response.text.splitlines()
+               if line.startswith('app_recsys_data_version_timestamp_seconds')]
+    assert metrics and all(float(value) > 0 for _, value in metrics)
@@ -0,0 +1,98 @@
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import scipy
+
+
+class InteractionsMatrix(NamedTuple):
+    """
+    User-item interactions matrix with id mappings.
+
+    Attributes:
+        - **matrix** - (user x item) csr matrix of interaction weights
+
+        - **user_ids** - sorted user ids: row index -> user_id
+
+        - **item_ids** - sorted item ids: column index -> item_id
+    """
+
+    matrix: scipy.sparse.csr_matrix
+    user_ids: np.ndarray
+    item_ids: np.ndarray
+
+    def save_ids(self, path: str):
+        """Save id mappings as .npy arrays to the directory."""
+
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        np.save(path / 'user_ids.npy', self.user_ids)
+        np.save(path / 'item_ids.npy', self.item_ids)
+
+
+def load_ids(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """Load id mappings (user_ids, item_ids) saved by `save_ids`."""
+
+    path = Path(path)
+
+    return np.load(path / 'user_ids.npy'), np.load(path / 'item_ids.npy')
+
+
+def build_interactions_matrix(
+    events: pd.DataFrame,
+    weights: dict[str, float] | None = None
+) -> InteractionsMatrix:
+    """
+    Build weighted user-item interactions matrix from the events table
+    with columns 'user_id', 'item_id' (and 'event' if weights are given).
+
+    Only events of types listed in weights are used, repeated events of the
+    same type with the same item are counted once, weights of different
+    event types with the same item are summed up. Without weights every
+    user-item pair gets weight 1.
+
+    Ids are encoded with pd.factorize (hash table, no python objects),
+    weights are looked up by categorical codes of event types and duplicates
+    are dropped by integer codes, so the matrix is built in a few vectorized
+    passes over the events.
+    """
+
+    user_ids = events['user_id'].to_numpy()
+    item_ids = events['item_id'].to_numpy()
+
+    # Коды типов событий: индекс в списке весов, -1 для остальных событий
+    if weights is not None:
+        event_codes = pd.Categorical(
+            events['event'], categories=list(weights)
+        ).codes.astype('int64')
+        mask = event_codes >= 0
+        user_ids, item_ids = user_ids[mask], item_ids[mask]
+        event_codes = event_codes[mask]
+        weight_values = np.array(list(weights.values()), dtype='float32')
+    else:
+        event_codes = np.zeros(len(user_ids), dtype='int64')
+        weight_values = np.ones(1, dtype='float32')
+
+    # Перекодируем идентификаторы в натуральный ряд {0, 1, ...}
+    # в порядке возрастания идентификаторов
+    user_codes, user_ids = pd.factorize(user_ids, sort=True)
+    item_codes, item_ids = pd.factorize(item_ids, sort=True)
+
+    # Удаляем повторные события: ключ (пользователь, товар, тип события)
+    # упаковываем в одно целое число
+    n_event_types = len(weight_values)
+    keys = pd.unique(
+        (user_codes * len(item_ids) + item_codes) * n_event_types
+        + event_codes
+    )
+    keys, event_codes = np.divmod(keys, n_event_types)
+    user_codes, item_codes = np.divmod(keys, len(item_ids))
+
+    # Веса разных событий с одним товаром суммируются при построении матрицы
+    matrix = scipy.sparse.csr_matrix(
+        (weight_values[event_codes], (user_codes, item_codes)),
+        shape=(len(user_ids), len(item_ids))
+    )
+
+    return InteractionsMatrix(matrix, user_ids, item_ids)